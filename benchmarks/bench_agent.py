@@ -0,0 +1,107 @@
+import os, sys, json, asyncio, argparse, importlib.util
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "utils", "langchain", "mcp-coraliser"))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_chat_model import ScriptedChatModel
+from fake_coral_server import FakeCoralServer
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+def load_agent(path):
+    spec = importlib.util.spec_from_file_location("coralised_agent", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+async def run_with_fake_coral(fake_coral, port, serve, timeout):
+    """Runs the agent coroutine serve() until fake_coral has every reply or timeout passes, then stops both."""
+    server_task = await fake_coral.start(port=port)
+    agent_task = asyncio.create_task(serve())
+    done_task = asyncio.create_task(fake_coral.done.wait())
+    try:
+        await asyncio.wait({agent_task, done_task}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if agent_task.done():
+            agent_task.result()
+        # Let the agent finish handling the last reply, e.g. recording it, before it is cancelled
+        await asyncio.wait({agent_task}, timeout=0.5)
+    finally:
+        for task in (agent_task, done_task):
+            task.cancel()
+        await asyncio.gather(agent_task, done_task, return_exceptions=True)
+        fake_coral.stop()
+        await asyncio.gather(server_task, return_exceptions=True)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark a generated main.py against a fake Coral server")
+    parser.add_argument("--agent", required=True, help="path to a generated coralised agent main.py")
+    parser.add_argument("--mentions", type=int, default=50, help="number of mentions to inject")
+    parser.add_argument("--rate", type=float, default=5.0, help="mentions injected per second")
+    parser.add_argument("--thread-size", type=int, default=1, help="consecutive mentions sent to the same thread")
+    parser.add_argument("--content", default="look up records about topic 1", help="content of every injected mention")
+    parser.add_argument("--port", type=int, default=5556, help="port for the fake Coral SSE server")
+    parser.add_argument("--llm-latency-ms", type=float, default=200, help="latency of each scripted model call")
+    parser.add_argument("--fast-llm-latency-ms", type=float, default=50,
+                        help="latency of the fast model when MODEL_FAST_NAME routing is on")
+    parser.add_argument("--tool-calls", type=int, default=1, help="agent tool calls per mention")
+    parser.add_argument("--parallel-tool-calls", action="store_true", help="request all tool calls in one model turn")
+    parser.add_argument("--timeout", type=float, default=300, help="give up after this many seconds")
+    parser.add_argument("--json", help="write the results to this file")
+    return parser.parse_args(argv)
+
+async def main(args):
+    os.environ["CORAL_SSE_URL"] = f"http://127.0.0.1:{args.port}/sse"
+    os.environ.setdefault("CORAL_AGENT_ID", "bench_agent")
+    os.environ.setdefault("CORAL_ORCHESTRATION_RUNTIME", "executable")
+
+    agent = load_agent(os.path.abspath(args.agent))
+    # Keep the agent's rate limiter (MODEL_RPM, MODEL_TPM) in front of the scripted model
+    rate_limiter = agent.create_rate_limiter(os.environ)
+    def create_model(env=None, *_args, **_kwargs):
+        # The fast model of MODEL_FAST_NAME routing gets its own latency
+        fast_name = os.environ.get("MODEL_FAST_NAME")
+        fast = bool(fast_name) and env is not None and env.get("MODEL_NAME") == fast_name
+        return ScriptedChatModel(
+            latency=(args.fast_llm_latency_ms if fast else args.llm_latency_ms) / 1000, tool_calls=args.tool_calls,
+            parallel=args.parallel_tool_calls, **(rate_limiter.model_kwargs() if rate_limiter is not None else {})
+        )
+    agent.create_model = create_model
+
+    streaming = os.environ.get("CORAL_REPLY_MODE") == "stream"
+    end_marker = os.environ.get("CORAL_STREAM_END_MARKER", "[END]") if streaming else None
+    fake_coral = FakeCoralServer(args.mentions, args.rate, content=args.content, end_marker=end_marker,
+                                 thread_size=args.thread_size)
+    await run_with_fake_coral(fake_coral, args.port, agent.main, args.timeout)
+
+    latencies = list(fake_coral.completed.values())
+    first_latencies = list(fake_coral.replies.values())
+    elapsed = (fake_coral.last_reply - fake_coral.started) if fake_coral.last_reply else 0.0
+    report = {
+        "mentions": args.mentions,
+        "replies": len(latencies),
+        "messages": fake_coral.messages,
+        "throughput_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_seconds": percentile(latencies, 0.50),
+        "p99_seconds": percentile(latencies, 0.99),
+        "max_seconds": max(latencies, default=0.0),
+        "first_message_p50_seconds": percentile(first_latencies, 0.50),
+        "first_message_p99_seconds": percentile(first_latencies, 0.99),
+    }
+    print("\nBenchmark: coralised agent")
+    print(f"  replies {report['replies']}/{report['mentions']}, throughput {report['throughput_per_second']:.2f}/s, "
+          f"p50 {report['p50_seconds']:.3f}s, p99 {report['p99_seconds']:.3f}s")
+    if streaming:
+        print(f"  {report['messages']} streamed messages, first message p50 {report['first_message_p50_seconds']:.3f}s, "
+              f"p99 {report['first_message_p99_seconds']:.3f}s")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,109 @@
+import os, sys, json, time, asyncio, argparse, statistics, subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "utils", "langchain", "mcp-coraliser"))
+sys.path.insert(0, BENCH_DIR)
+
+import coraliser
+from fake_chat_model import ScriptedChatModel
+
+
+def stub_server_args(args):
+    return [os.path.join(BENCH_DIR, "stub_mcp_server.py"), "--tools", str(args.tools),
+            "--schema-fields", str(args.schema_fields), "--latency-ms", str(args.tool_latency_ms),
+            "--exit-after", str(args.tool_exit_after), "--response-bytes", str(args.tool_response_bytes)]
+
+def write_settings(workdir, args):
+    if args.transport == "streamable_http":
+        # Every stub agent uses the one shared stub server
+        server = {"transport": "streamable_http", "url": f"http://127.0.0.1:{args.http_port}/mcp/"}
+    else:
+        server = {"transport": "stdio", "command": sys.executable, "args": stub_server_args(args)}
+    servers = {f"stub_{index}": dict(server) for index in range(args.servers)}
+    agent_settings = json.loads(args.agent_settings) if args.agent_settings else {}
+    with open(os.path.join(workdir, "coraliser_settings.json"), "w") as f:
+        json.dump({"mcpServers": servers, "agentSettings": {name: agent_settings for name in servers}}, f, indent=2)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark coraliser.main against local stub MCP servers")
+    parser.add_argument("--workdir", default="bench_workdir", help="directory for settings and generated agents")
+    parser.add_argument("--servers", type=int, default=8, help="number of stub MCP servers")
+    parser.add_argument("--tools", type=int, default=20, help="tools per stub server")
+    parser.add_argument("--schema-fields", type=int, default=5, help="extra schema fields per tool")
+    parser.add_argument("--tool-latency-ms", type=float, default=50)
+    parser.add_argument("--tool-exit-after", type=int, default=0,
+                        help="stub servers crash after this many tool calls, to exercise agent reconnects")
+    parser.add_argument("--tool-response-bytes", type=int, default=256, help="size of each stub tool result")
+    parser.add_argument("--transport", choices=("stdio", "streamable_http"), default="stdio",
+                        help="stdio starts a stub server per agent, streamable_http shares one stub server")
+    parser.add_argument("--http-port", type=int, default=8931, help="port of the shared streamable HTTP stub server")
+    parser.add_argument("--agent-settings", help="agentSettings JSON applied to every generated stub agent")
+    parser.add_argument("--llm-latency-ms", type=float, default=500, help="latency of the scripted description call")
+    parser.add_argument("--jobs", type=int, default=coraliser.DEFAULT_JOBS)
+    parser.add_argument("--runs", type=int, default=2, help="repeat runs; later runs exercise the cache and manifest")
+    parser.add_argument("--cold", action="store_true", help="pass --refresh to every run")
+    parser.add_argument("--json", help="write the results to this file")
+    return parser.parse_args(argv)
+
+async def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+async def run_coraliser(args):
+    report = []
+    for run in range(args.runs):
+        coraliser_args = ["--jobs", str(args.jobs)] + (["--refresh"] if args.cold else [])
+        started = time.perf_counter()
+        results = await coraliser.main(coraliser.parse_args(coraliser_args))
+        elapsed = time.perf_counter() - started
+        totals = [timings.get("total", 0.0) for _, _, timings in results]
+        report.append({
+            "run": run,
+            "wall_seconds": elapsed,
+            "mean_server_seconds": statistics.mean(totals) if totals else 0.0,
+            "max_server_seconds": max(totals, default=0.0),
+            "servers": {name: {"status": status, **timings} for name, status, timings in results},
+        })
+    return report
+
+async def main(args):
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)
+    write_settings(".", args)
+    coraliser.init_chat_model = lambda **kwargs: ScriptedChatModel(
+        latency=args.llm_latency_ms / 1000,
+        **{key: value for key, value in kwargs.items() if key in ("rate_limiter", "callbacks")}
+    )
+
+    http_server = None
+    if args.transport == "streamable_http":
+        http_server = subprocess.Popen([sys.executable] + stub_server_args(args) +
+                                       ["--transport", "streamable-http", "--port", str(args.http_port)])
+        await wait_for_port(args.http_port)
+    try:
+        report = await run_coraliser(args)
+    finally:
+        if http_server is not None:
+            http_server.terminate()
+            http_server.wait()
+
+    print("\nBenchmark: coraliser.main")
+    for entry in report:
+        print(f"  run {entry['run']}: wall {entry['wall_seconds']:.2f}s, "
+              f"per-server mean {entry['mean_server_seconds']:.2f}s, max {entry['max_server_seconds']:.2f}s")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
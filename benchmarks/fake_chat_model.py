@@ -0,0 +1,145 @@
+import re, json, time, asyncio
+from typing import Any
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatResult
+from base_coraliser import get_tool_schema
+
+CORAL_TOOL_NAMES = {"wait_for_mentions", "send_message", "list_agents", "create_thread",
+                    "add_participant", "remove_participant", "close_thread"}
+
+
+def fill_arguments(schema, content):
+    arguments = {}
+    properties = schema.get("properties", {})
+    for name in schema.get("required", list(properties)[:1]):
+        field_type = properties.get(name, {}).get("type", "string")
+        arguments[name] = {"integer": 1, "number": 1, "boolean": False, "array": [], "object": {}}.get(field_type, content)
+    return arguments
+
+class ScriptedChatModel(BaseChatModel):
+    """Offline chat model that follows the coralised agent workflow with a fixed latency.
+
+    In direct mode it calls `tool_calls` agent tools and then answers. In llm mode it first calls
+    wait_for_mentions, then the agent tools, then send_message. With `parallel` the direct mode
+    tool calls are all requested in one turn. Without bound tools it returns a coraliser description.
+    """
+
+    latency: float = 0.05
+    tool_calls: int = 1
+    parallel: bool = False
+    bound_tools: list = []
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.model_copy(update={"bound_tools": list(tools)})
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=self.next_message(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self.next_message(messages))])
+
+    def tool_call(self, name, arguments, step):
+        return AIMessage(content="", tool_calls=[{"name": name, "args": arguments, "id": f"call_{step}"}],
+                         usage_metadata={"input_tokens": 500, "output_tokens": 20, "total_tokens": 520})
+
+    def answer(self, content):
+        return AIMessage(content=content, usage_metadata={"input_tokens": 500, "output_tokens": 40, "total_tokens": 540})
+
+    def next_message(self, messages):
+        if not self.bound_tools:
+            prompt = " ".join(str(message.content) for message in messages)
+            agent = re.search(r"start with `(\S+) agent", prompt)
+            name = agent.group(1) if agent else "stub"
+            return self.answer(json.dumps({"description": f"{name} agent capable of answering benchmark lookups."}))
+
+        agent_tools = [tool for tool in self.bound_tools if tool.name not in CORAL_TOOL_NAMES]
+        tool_results = [message for message in messages if isinstance(message, ToolMessage)]
+        human = next((str(message.content) for message in messages if isinstance(message, HumanMessage)), None)
+
+        if human is not None:
+            mention = re.search(r"Mention from (\S+) in thread (\S+): (.*)", human, re.S)
+            content = mention.group(3) if mention else human
+            if agent_tools and self.parallel and not tool_results:
+                tools = [agent_tools[index % len(agent_tools)] for index in range(self.tool_calls)]
+                return AIMessage(content="", tool_calls=[
+                    {"name": tool.name, "args": fill_arguments(get_tool_schema(tool), content), "id": f"call_{index}"}
+                    for index, tool in enumerate(tools)
+                ], usage_metadata={"input_tokens": 500, "output_tokens": 20 * len(tools), "total_tokens": 500 + 20 * len(tools)})
+            if agent_tools and not self.parallel and len(tool_results) < self.tool_calls:
+                tool = agent_tools[len(tool_results) % len(agent_tools)]
+                return self.tool_call(tool.name, fill_arguments(get_tool_schema(tool), content), len(tool_results))
+            result = tool_results[-1].content if tool_results else content
+            # Coalesced mentions are answered one numbered line each
+            numbered = re.findall(r"^\[(\d+)\] From \S+: (.*)$", content, re.M)
+            if numbered:
+                return self.answer("\n".join(f"[{number}] Done: {text}" for number, text in numbered))
+            return self.answer(f"Done: {result}")
+
+        # llm mode: the model drives wait_for_mentions and send_message itself
+        if not tool_results:
+            return self.tool_call("wait_for_mentions", {"timeoutMs": 30000}, 0)
+        mention = re.search(r'threadId="([^"]*)"[^>]*senderId="([^"]*)"[^>]*content="([^"]*)"', str(tool_results[0].content))
+        if mention is None:
+            return self.answer("No mentions received")
+        thread_id, sender_id, content = mention.groups()
+        if agent_tools and len(tool_results) < self.tool_calls + 1:
+            tool = agent_tools[(len(tool_results) - 1) % len(agent_tools)]
+            return self.tool_call(tool.name, fill_arguments(get_tool_schema(tool), content), len(tool_results))
+        if len(tool_results) < self.tool_calls + 2:
+            return self.tool_call("send_message", {"threadId": thread_id, "content": f"Done: {tool_results[-1].content}",
+                                                   "mentions": [sender_id]}, len(tool_results))
+        return self.answer("Replied to mention")
+
+class ReplayChatModel(BaseChatModel):
+    """Chat model that answers each mention with the responses recorded for it, in order.
+
+    `responses` maps a mention's message id to its recorded model responses, and `mention_var` is the
+    agent's current_mention. Recorded latency is multiplied by `latency_scale`. Once a mention's
+    responses run out, it gets its last recorded answer again.
+    """
+
+    responses: dict = {}
+    cursors: dict = {}
+    mention_var: Any = None
+    latency_scale: float = 1.0
+
+    @property
+    def _llm_type(self):
+        return "replay"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        response = self.next_response()
+        time.sleep(response["seconds"] * self.latency_scale)
+        return self.to_result(response)
+
+    def next_response(self):
+        mention = self.mention_var.get() if self.mention_var is not None else None
+        key = str(mention["message_id"]) if mention else None
+        recorded = self.responses.get(key, [])
+        cursor = self.cursors.get(key, 0)
+        if cursor < len(recorded):
+            self.cursors[key] = cursor + 1
+            return recorded[cursor]
+        answers = [response for response in recorded
+                   if "message" in response and not response["message"]["data"].get("tool_calls")]
+        return answers[-1] if answers else {"seconds": 0.0, "message": {"type": "ai", "data": {"content": "No recorded response"}}}
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        response = self.next_response()
+        await asyncio.sleep(response["seconds"] * self.latency_scale)
+        return self.to_result(response)
+
+    def to_result(self, response):
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        message = messages_from_dict([response["message"]])[0]
+        return ChatResult(generations=[ChatGeneration(message=message)])
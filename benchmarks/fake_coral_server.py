@@ -0,0 +1,127 @@
+import argparse, asyncio, html, time
+import uvicorn
+from mcp.server.fastmcp import FastMCP
+
+
+class FakeCoralServer:
+    """Coral SSE stand-in that injects mentions at a fixed rate and records reply latency.
+
+    With `thread_size`, that many consecutive mentions share a thread, each from its own sender. A
+    `script` of mentions ({"offset", "id", "thread_id", "sender_id", "content"}) replaces the fixed
+    rate, e.g. to replay recorded traffic. `replies` holds the latency of the first message sent for
+    each mention. A message answers the oldest pending mention in its thread from each sender it
+    mentions, or the oldest one when it mentions none of them. With an `end_marker`, a mention
+    completes on a message ending with it (streamed replies); otherwise the first message completes it.
+    """
+
+    def __init__(self, mentions=100, rate=10.0, sender_id="bench_orchestrator", content="look up records about topic 1",
+                 end_marker=None, script=None, thread_size=1):
+        self.script = script or [
+            {"offset": index / rate, "id": f"bench-message-{index}",
+             "thread_id": f"bench-thread-{index // thread_size}",
+             "sender_id": sender_id if thread_size == 1 else f"{sender_id}_{index % thread_size}",
+             "content": content}
+            for index in range(mentions)
+        ]
+        self.mentions = len(self.script)
+        self.end_marker = end_marker
+        self.started = None
+        self.delivered = 0
+        self.pending = {}
+        self.replies = {}
+        self.completed = {}
+        self.messages = 0
+        self.last_reply = None
+        self.done = asyncio.Event()
+        self.mcp = FastMCP("fake-coral", log_level="WARNING")
+        self.mcp.add_tool(self.wait_for_mentions)
+        self.mcp.add_tool(self.send_message)
+        self.mcp.add_tool(self.list_agents)
+        self.server = None
+
+    def due_at(self, index):
+        return self.started + self.script[index]["offset"]
+
+    def format_mention(self, index):
+        mention = self.script[index]
+        self.pending.setdefault(mention["thread_id"], []).append(index)
+        attributes = {
+            "id": str(mention["id"]),
+            "threadName": mention["thread_id"],
+            "threadId": mention["thread_id"],
+            "senderId": mention["sender_id"],
+            "content": mention["content"],
+            "timestamp": str(int(self.due_at(index) * 1000)),
+        }
+        return "<ResolvedMessage " + " ".join(f'{key}="{html.escape(value)}"' for key, value in attributes.items()) + "/>"
+
+    async def wait_for_mentions(self, timeoutMs: int) -> str:
+        """Wait for mentions addressed to this agent."""
+        if self.started is None:
+            self.started = time.perf_counter()
+        deadline = time.perf_counter() + timeoutMs / 1000
+        while True:
+            now = time.perf_counter()
+            due = [index for index in range(self.delivered, self.mentions) if self.due_at(index) <= now]
+            if due:
+                self.delivered = due[-1] + 1
+                return "\n".join(self.format_mention(index) for index in due)
+            if self.delivered >= self.mentions or now >= deadline:
+                return "No new messages received within the timeout period"
+            await asyncio.sleep(min(self.due_at(self.delivered), deadline) - now)
+
+    async def send_message(self, threadId: str, content: str, mentions: list[str]) -> str:
+        """Send a message to a thread, mentioning the given agents."""
+        pending = self.pending.get(threadId)
+        if pending:
+            answered = [
+                index for index in (
+                    next((index for index in pending if self.script[index]["sender_id"] == sender), None)
+                    for sender in dict.fromkeys(mentions)
+                ) if index is not None
+            ] or [pending[0]]
+            now = time.perf_counter()
+            self.messages += 1
+            for index in answered:
+                self.replies.setdefault(index, now - self.due_at(index))
+                if self.end_marker is None or content.rstrip().endswith(self.end_marker):
+                    pending.remove(index)
+                    self.last_reply = now
+                    self.completed[index] = now - self.due_at(index)
+            if len(self.completed) >= self.mentions:
+                self.done.set()
+        return "Message sent successfully"
+
+    async def list_agents(self, includeDetails: bool = False) -> str:
+        """List the agents connected to the session."""
+        return "[]"
+
+    async def start(self, host="127.0.0.1", port=5556):
+        config = uvicorn.Config(self.mcp.sse_app(), host=host, port=port, log_level="warning")
+        self.server = uvicorn.Server(config)
+        task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            if task.done():
+                task.result()
+            await asyncio.sleep(0.05)
+        return task
+
+    def stop(self):
+        if self.server is not None:
+            self.server.should_exit = True
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fake Coral SSE server for benchmarks")
+    parser.add_argument("--port", type=int, default=5556)
+    parser.add_argument("--mentions", type=int, default=100, help="number of mentions to inject")
+    parser.add_argument("--rate", type=float, default=10.0, help="mentions injected per second")
+    return parser.parse_args(argv)
+
+async def main(args):
+    fake_coral = FakeCoralServer(args.mentions, args.rate)
+    task = await fake_coral.start(port=args.port)
+    print(f"Fake Coral server listening on http://127.0.0.1:{args.port}/sse")
+    await task
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,241 @@
+import os, sys, json, asyncio, argparse, urllib.parse
+from collections import defaultdict, deque
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from langchain_core.tools import StructuredTool, ToolException
+from langchain_mcp_adapters.client import MultiServerMCPClient
+from bench_agent import load_agent, percentile, run_with_fake_coral
+from fake_chat_model import ReplayChatModel
+from fake_coral_server import FakeCoralServer
+
+
+def read_sessions(path):
+    # An agent appends one session per run to its CORAL_RECORD_FILE
+    sessions = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event["type"] == "session" or not sessions:
+                sessions.append([])
+            sessions[-1].append(event)
+    return [RecordedSession(events) for events in sessions]
+
+class RecordedSession:
+    """One recorded agent session, indexed by mention for replay and comparison."""
+
+    def __init__(self, events):
+        self.events = events
+        header = next((event for event in events if event["type"] == "session"), {})
+        self.agent_id = header.get("agent_id")
+        self.tools = header.get("tools", [])
+        self.mentions = [event for event in events if event["type"] == "mention"]
+
+    def of_type(self, kind):
+        return [event for event in self.events if event["type"] == kind]
+
+    def model_responses(self):
+        responses = defaultdict(list)
+        for event in self.of_type("model_response"):
+            responses[str(event["mention"])].append(event)
+        return dict(responses)
+
+    def tool_results(self, make_key):
+        # Each result is queued under its arguments and under its tool name, as an index into the events.
+        # make_key is the agent's tool cache key, so replay matches calls the way the agent caches them
+        events = self.of_type("tool")
+        results = defaultdict(deque)
+        for index, event in enumerate(events):
+            results[make_key(event["name"], event["arguments"])].append(index)
+            results[event["name"]].append(index)
+        return events, results
+
+    def steps(self, mention_ids=None):
+        """Per step timings, keyed by the recorded mention id each event belongs to."""
+        mention_ids = mention_ids or {}
+        replies = {}
+        model_calls = defaultdict(list)
+        tool_calls = defaultdict(list)
+        for event in self.events:
+            mention = mention_ids.get(event["mention"], event["mention"])
+            if event["type"] == "reply":
+                replies[mention] = event["seconds"]
+            elif event["type"] == "model_request":
+                model_calls[mention].append({"bytes": event["bytes"], "seconds": None, "input_tokens": 0})
+            elif event["type"] == "model_response" and model_calls[mention]:
+                call = next((call for call in model_calls[mention] if call["seconds"] is None), model_calls[mention][-1])
+                call["seconds"] = event["seconds"]
+                usage = event.get("message", {}).get("data", {}).get("usage_metadata") or {}
+                call["input_tokens"] = usage.get("input_tokens", 0)
+            elif event["type"] == "tool":
+                tool_calls[event["name"]].append(event["seconds"])
+        return replies, model_calls, tool_calls
+
+class ReplayMcpSession:
+    """Stands in for the agent's MCP session, answering tool calls with the recorded results.
+
+    Calls are matched on tool name and arguments, then on tool name alone. A result is used once
+    through either lookup. Once the recorded results for a call run out, the last one is returned again.
+    """
+
+    def __init__(self, recorded, make_key, latency_scale=1.0):
+        self.server_name = "replay"
+        self.snapshot = None
+        self.breaker = None
+        self.tools = recorded.tools
+        self.events, self.results = recorded.tool_results(make_key)
+        self.make_key = make_key
+        self.used = set()
+        self.latency_scale = latency_scale
+        self.ready = asyncio.Event()
+        self.ready.set()
+        # The recorded tools never change, so the agent's schema watch never sees a new session
+        self.generation = 1
+        self.state_changed = asyncio.Event()
+
+    def live_fingerprint(self):
+        return None
+
+    def next_result(self, name, arguments):
+        for key in (self.make_key(name, arguments), name):
+            results = self.results.get(key)
+            if not results:
+                continue
+            # Skip results already taken through the other lookup
+            while len(results) > 1 and results[0] in self.used:
+                results.popleft()
+            index = results.popleft() if len(results) > 1 else results[0]
+            self.used.add(index)
+            return self.events[index]
+        return None
+
+    async def call(self, name, arguments):
+        result = self.next_result(name, arguments)
+        if result is None:
+            raise ToolException(f"No recorded result for {name}")
+        await asyncio.sleep(result["seconds"] * self.latency_scale)
+        if "error" in result:
+            raise ToolException(result["error"])
+        return result["content"], None
+
+    def create_tool(self, tool):
+        async def call_tool(**arguments):
+            return await self.call(tool["name"], arguments)
+        return StructuredTool(name=tool["name"], description=tool["description"], args_schema=tool["schema"],
+                              coroutine=call_tool, response_format="content_and_artifact")
+
+    def get_tools(self):
+        return [self.create_tool(tool) for tool in self.tools]
+
+    async def aclose(self):
+        pass
+
+def summarize(values):
+    return {"count": len(values), "p50": percentile(values, 0.50), "p99": percentile(values, 0.99),
+            "total": sum(values)}
+
+def compare(recorded, replayed):
+    # Replayed mentions carry the recorded mention id as their message id
+    mention_ids = {event["mention"]: int(event["message_id"]) for event in replayed.mentions}
+    before = recorded.steps()
+    after = replayed.steps(mention_ids)
+    report = {"mentions": len(recorded.mentions), "replies": len(after[0]), "steps": {}, "mentions_slower": []}
+    report["steps"]["reply"] = [summarize(list(before[0].values())), summarize(list(after[0].values()))]
+    for field in ("seconds", "bytes", "input_tokens"):
+        report["steps"][f"model call {field}"] = [
+            summarize([call[field] or 0 for calls in steps[1].values() for call in calls]) for steps in (before, after)
+        ]
+    report["steps"]["model calls per mention"] = [
+        summarize([len(steps[1].get(event["mention"], [])) for event in recorded.mentions]) for steps in (before, after)
+    ]
+    for name in sorted(set(before[2]) | set(after[2])):
+        report["steps"][f"tool {name}"] = [summarize(steps[2].get(name, [])) for steps in (before, after)]
+    report["mentions_slower"] = sorted(
+        ({"mention": mention, "recorded": seconds, "replay": after[0][mention], "diff": after[0][mention] - seconds}
+         for mention, seconds in before[0].items() if mention in after[0]),
+        key=lambda item: item["diff"], reverse=True
+    )[:5]
+    return report
+
+def print_report(report):
+    print(f"\nReplay: {report['replies']}/{report['mentions']} mentions answered")
+    print(f"  {'step':<28}{'count':>12}{'p50 recorded':>14}{'p50 replay':>12}{'diff':>10}")
+    for step, (before, after) in report["steps"].items():
+        digits = 3 if step == "reply" or step.startswith("tool") or step.endswith("seconds") else 1
+        counts = f"{before['count']}/{after['count']}"
+        print(f"  {step:<28}{counts:>12}{before['p50']:>14.{digits}f}{after['p50']:>12.{digits}f}"
+              f"{after['p50'] - before['p50']:>+10.{digits}f}")
+    if report["mentions_slower"]:
+        print("  Mentions with the largest reply latency increase:")
+        for item in report["mentions_slower"]:
+            print(f"    mention {item['mention']}: {item['recorded']:.3f}s -> {item['replay']:.3f}s ({item['diff']:+.3f}s)")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded session against a generated main.py and compare step timings")
+    parser.add_argument("--agent", required=True, help="path to the (modified) generated coralised agent main.py")
+    parser.add_argument("--log", required=True, help="log recorded with CORAL_RECORD_FILE")
+    parser.add_argument("--session", type=int, default=0, help="which recorded session in the log to replay")
+    parser.add_argument("--output", default="replay.jsonl", help="record the replay to this log")
+    parser.add_argument("--speed", type=float, default=1.0, help="inject the recorded mentions this many times faster")
+    parser.add_argument("--model-latency-scale", type=float, default=1.0, help="multiply the recorded model latency")
+    parser.add_argument("--tool-latency-scale", type=float, default=1.0, help="multiply the recorded tool latency")
+    parser.add_argument("--port", type=int, default=5556, help="port for the fake Coral SSE server")
+    parser.add_argument("--timeout", type=float, default=600, help="give up after this many seconds")
+    parser.add_argument("--json", help="write the comparison to this file")
+    return parser.parse_args(argv)
+
+async def main(args):
+    recorded = read_sessions(args.log)[args.session]
+    if not recorded.mentions:
+        raise SystemExit("The session has no recorded mentions; record it with CORAL_POLL_MODE=direct")
+    env = dict(os.environ)
+    env.setdefault("CORAL_AGENT_ID", recorded.agent_id or "replay_agent")
+    env["CORAL_POLL_MODE"] = "direct"
+
+    agent = load_agent(os.path.abspath(args.agent))
+    # Keep the agent's rate limiter (MODEL_RPM, MODEL_TPM) in front of the recorded responses
+    rate_limiter = agent.create_rate_limiter(env)
+    model = ReplayChatModel(responses=recorded.model_responses(), mention_var=agent.current_mention,
+                            latency_scale=args.model_latency_scale,
+                            **(rate_limiter.model_kwargs() if rate_limiter is not None else {}))
+    # The fast model of MODEL_FAST_NAME routing replays the same responses
+    agent.create_model = lambda *_args, **_kwargs: model
+
+    first = recorded.mentions[0]["t"]
+    script = [
+        {"offset": (event["t"] - first) / args.speed, "id": event["mention"], "thread_id": event["thread_id"],
+         "sender_id": event["sender_id"], "content": event["content"]}
+        for event in recorded.mentions
+    ]
+    streaming = env.get("CORAL_REPLY_MODE") == "stream"
+    end_marker = env.get("CORAL_STREAM_END_MARKER", "[END]") if streaming else None
+    fake_coral = FakeCoralServer(script=script, end_marker=end_marker)
+
+    async def serve():
+        query_string = urllib.parse.urlencode({"agentId": env["CORAL_AGENT_ID"], "agentDescription": "replay"})
+        client = MultiServerMCPClient(connections={"coral": {
+            "transport": "sse", "url": f"http://127.0.0.1:{args.port}/sse?{query_string}",
+            "timeout": 300, "sse_read_timeout": 300
+        }})
+        agent.recorder.configure(args.output)
+        coral_session = agent.create_session(client, "coral", env)
+        mcp_session = ReplayMcpSession(recorded, agent.ToolResultCache.make_key, args.tool_latency_scale)
+        try:
+            await agent.serve_agent(env, model, coral_session, mcp_session)
+        finally:
+            await coral_session.aclose()
+            agent.recorder.configure(None)
+
+    await run_with_fake_coral(fake_coral, args.port, serve, args.timeout)
+
+    report = compare(recorded, read_sessions(args.output)[-1])
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,76 @@
+import os, argparse, asyncio
+import mcp.types as types
+from mcp.server.lowlevel import Server
+from mcp.server.stdio import stdio_server
+
+
+def build_tools(tool_count, schema_fields):
+    tools = []
+    for index in range(tool_count):
+        properties = {"query": {"type": "string", "description": f"Query for stub tool {index}"}}
+        for field in range(schema_fields):
+            properties[f"field_{field}"] = {
+                "type": "string",
+                "description": f"Optional stub field {field} used to pad the schema of tool {index}"
+            }
+        tools.append(types.Tool(
+            name=f"stub_tool_{index}",
+            description=f"Stub tool {index} that looks up records about topic {index}",
+            inputSchema={"type": "object", "properties": properties, "required": ["query"]}
+        ))
+    return tools
+
+async def serve_http(server, host, port):
+    # One streamable HTTP server can back many generated agents instead of a subprocess each
+    import uvicorn
+    from mcp.server.streamable_http_manager import StreamableHTTPSessionManager
+    from starlette.applications import Starlette
+    from starlette.routing import Mount
+    manager = StreamableHTTPSessionManager(app=server)
+    app = Starlette(routes=[Mount("/mcp", app=manager.handle_request)])
+    async with manager.run():
+        await uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning")).serve()
+
+async def serve(tool_count, schema_fields, latency_ms, response_bytes, exit_after=0, transport="stdio",
+                host="127.0.0.1", port=8931):
+    server = Server("stub-mcp")
+    tools = build_tools(tool_count, schema_fields)
+    calls = 0
+
+    @server.list_tools()
+    async def list_tools():
+        return tools
+
+    @server.call_tool()
+    async def call_tool(name, arguments):
+        nonlocal calls
+        calls += 1
+        if exit_after and calls > exit_after:
+            # Simulate a crashed server process mid-call
+            os._exit(1)
+        await asyncio.sleep(latency_ms / 1000)
+        text = f"{name} result for {arguments.get('query', '')}"
+        return [types.TextContent(type="text", text=text.ljust(response_bytes, "."))]
+
+    if transport == "streamable-http":
+        await serve_http(server, host, port)
+        return
+    async with stdio_server() as (read_stream, write_stream):
+        await server.run(read_stream, write_stream, server.create_initialization_options())
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Stub MCP server for benchmarks")
+    parser.add_argument("--tools", type=int, default=10, help="number of tools to expose")
+    parser.add_argument("--schema-fields", type=int, default=5, help="extra schema fields per tool")
+    parser.add_argument("--latency-ms", type=float, default=50, help="latency of each tool call")
+    parser.add_argument("--response-bytes", type=int, default=256, help="size of each tool result")
+    parser.add_argument("--exit-after", type=int, default=0, help="crash the process on the call after this many (0 never)")
+    parser.add_argument("--transport", choices=("stdio", "streamable-http"), default="stdio")
+    parser.add_argument("--host", default="127.0.0.1", help="address for the streamable HTTP transport")
+    parser.add_argument("--port", type=int, default=8931, help="port for the streamable HTTP transport, served at /mcp/")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    asyncio.run(serve(args.tools, args.schema_fields, args.latency_ms, args.response_bytes, args.exit_after,
+                      args.transport, args.host, args.port))
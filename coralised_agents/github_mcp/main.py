@@ -1,11 +1,195 @@
 import urllib.parse
 from dotenv import load_dotenv
-import os, json, asyncio, traceback
+import os, re, json, html, math, time, random, asyncio, hashlib, threading, traceback
+import anyio, httpx
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from collections import Counter, OrderedDict
+from contextlib import AsyncExitStack, contextmanager
+from contextvars import ContextVar
 from langchain.chat_models import init_chat_model
 from langchain.prompts import ChatPromptTemplate
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import load_mcp_tools
 from langchain.agents import create_tool_calling_agent, AgentExecutor
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.messages import message_to_dict
+from langchain_core.rate_limiters import BaseRateLimiter
+from langchain_core.tools import StructuredTool, ToolException
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED
 
+# Per-agent settings from the "agentSettings" section of coraliser_settings.json
+AGENT_SETTINGS = {'toolCache': {'maxEntries': 256, 'tools': {'search_repositories': 300, 'search_code': 300, 'get_file_contents': 60}}, 'toolOutput': {'maxBytes': 32000, 'maxTokens': 6000, 'mode': 'head_tail', 'tools': {'get_file_contents': {'maxBytes': 24000, 'mode': 'chunk'}}}}
+
+# Name of the agent's MCP server in the client connections
+MCP_SERVER = "github_mcp"
+
+# Tool schemas captured by the coraliser, so the agent can serve mentions before its MCP server is up
+TOOL_SNAPSHOT = None
+
+class Metrics:
+    """Latency histograms and counters exported as Prometheus text or JSONL. Disabled by default."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.enabled = False
+        self.histograms = {}
+        self.counters = {}
+        self.file = None
+        self.callbacks = []
+
+    def configure(self, exporter="off", path=None):
+        self.enabled = exporter in ("prometheus", "jsonl")
+        if exporter == "jsonl":
+            self.file = open(path or "metrics.jsonl", "a", buffering=1)
+        self.callbacks = [MetricsCallbackHandler(self)] if self.enabled else []
+        return self.enabled
+
+    def write_event(self, kind, name, value, labels):
+        if self.file is not None:
+            self.file.write(json.dumps({"ts": time.time(), "type": kind, "metric": name, "value": value, **labels}) + "\n")
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0}
+        for index, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][index] += 1
+                break
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+        self.write_event("histogram", name, seconds, labels)
+
+    def increment(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+        self.write_event("counter", name, value, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, status=status, **labels)
+
+    def format_labels(self, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in pairs) + "}"
+
+    def render_prometheus(self):
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(
+                f"{name}{self.format_labels(labels)} {value}"
+                for (counter_name, labels), value in self.counters.items() if counter_name == name
+            )
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (histogram_name, labels), histogram in self.histograms.items():
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host, port):
+        async def handle(reader, writer):
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+                body = self.render_prometheus().encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                    + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+        server = await asyncio.start_server(handle, host, port)
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+class MetricsCallbackHandler(AsyncCallbackHandler):
+    """Records model and tool call latency, tokens and errors into Metrics."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.runs = {}
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id, invocation_params=None, **kwargs):
+        params = invocation_params or {}
+        model = params.get("model") or params.get("model_name") or (serialized or {}).get("name", "model")
+        self.runs[run_id] = ("model", model, time.perf_counter())
+
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        kind, model, started = self.runs.pop(run_id, ("model", "model", None))
+        if started is not None:
+            self.metrics.observe("coral_model_call_seconds", time.perf_counter() - started, model=model, status="ok")
+        self.metrics.increment("coral_model_calls_total", model=model, status="ok")
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                if usage:
+                    self.metrics.increment("coral_model_tokens_total", usage.get("input_tokens", 0), model=model, type="input")
+                    self.metrics.increment("coral_model_tokens_total", usage.get("output_tokens", 0), model=model, type="output")
+
+    async def on_llm_error(self, error, *, run_id, **kwargs):
+        kind, model, started = self.runs.pop(run_id, ("model", "model", None))
+        if started is not None:
+            self.metrics.observe("coral_model_call_seconds", time.perf_counter() - started, model=model, status="error")
+        self.metrics.increment("coral_model_calls_total", model=model, status="error")
+
+    async def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self.runs[run_id] = ("tool", (serialized or {}).get("name", "tool"), time.perf_counter())
+
+    async def on_tool_end(self, output, *, run_id, **kwargs):
+        self.record_tool(run_id, "ok")
+
+    async def on_tool_error(self, error, *, run_id, **kwargs):
+        self.record_tool(run_id, "error")
+
+    def record_tool(self, run_id, status):
+        kind, tool, started = self.runs.pop(run_id, ("tool", "tool", None))
+        if started is not None:
+            self.metrics.observe("coral_tool_call_seconds", time.perf_counter() - started, tool=tool, status=status)
+        self.metrics.increment("coral_tool_calls_total", tool=tool, status=status)
+
+metrics = Metrics()
+
+async def configure_metrics():
+    exporter = os.getenv("CORAL_METRICS", "off")
+    metrics.configure(exporter, os.getenv("CORAL_METRICS_FILE", "metrics.jsonl"))
+    if exporter == "prometheus":
+        return await metrics.serve(os.getenv("CORAL_METRICS_HOST", "127.0.0.1"), int(os.getenv("CORAL_METRICS_PORT", "9464")))
+    return None
 
 def get_tools_description(tools):
     return "\n".join(
@@ -13,7 +197,1399 @@ def get_tools_description(tools):
         for tool in tools
     )
 
-async def create_agent(coral_tools, agent_tools):
+def get_tool_schema(tool):
+    schema = tool.args_schema
+    if isinstance(schema, dict):
+        return schema
+    return schema.model_json_schema() if schema is not None else {}
+
+def tools_fingerprint(tools):
+    tools = sorted(([tool.name, tool.args] for tool in tools), key=lambda item: item[0])
+    return hashlib.sha256(json.dumps(tools, sort_keys=True).encode()).hexdigest()
+
+def normalize_mention(message):
+    thread_id = message.get("threadId") or message.get("thread_id")
+    sender_id = message.get("senderId") or message.get("sender_id") or message.get("sender")
+    if not thread_id or not sender_id:
+        return None
+    return {
+        "message_id": message.get("id") or message.get("messageId"),
+        "thread_id": thread_id,
+        "sender_id": sender_id,
+        "content": message.get("content", ""),
+    }
+
+def parse_mentions(result):
+    if isinstance(result, (list, tuple)):
+        result = "\n".join(str(item) for item in result)
+    result = str(result)
+    try:
+        data = json.loads(result)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        data = data.get("messages", [])
+    if isinstance(data, list):
+        messages = [message for message in data if isinstance(message, dict)]
+    else:
+        # Coral formats messages as <ResolvedMessage threadId="..." senderId="..." content="..."/>
+        messages = [
+            {key: html.unescape(value) for key, value in re.findall(r'(\w+)="([^"]*)"', match.group(1))}
+            for match in re.finditer(r'<ResolvedMessage\b((?:\s+\w+="[^"]*")*)\s*/?>', result)
+        ]
+    return [mention for mention in map(normalize_mention, messages) if mention]
+
+STOP_WORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it", "of",
+              "on", "or", "the", "this", "to", "with", "me", "my", "please", "can", "you", "i"}
+
+def tokenize(text):
+    words = re.findall(r"[a-z0-9]+", re.sub(r"([a-z])([A-Z])", r"\1 \2", str(text)).lower())
+    return [word[:-1] if len(word) > 3 and word.endswith("s") else word for word in words if word not in STOP_WORDS]
+
+def get_schema_text(schema):
+    if isinstance(schema, dict):
+        return " ".join(
+            f"{key if key not in ('type', 'required', 'additionalProperties') else ''} {get_schema_text(value)}"
+            for key, value in schema.items()
+        )
+    if isinstance(schema, list):
+        return " ".join(get_schema_text(value) for value in schema)
+    return str(schema) if isinstance(schema, str) else ""
+
+class ToolIndex:
+    """BM25 index over tool names, descriptions and schema fields, used to pick tools per mention."""
+
+    def __init__(self, tools, k1=1.5, b=0.75):
+        self.tools = tools
+        self.k1 = k1
+        self.b = b
+        self.documents = [
+            Counter(tokenize(f"{tool.name.replace('_', ' ')} {tool.description} {get_schema_text(tool.args)}"))
+            for tool in tools
+        ]
+        self.lengths = [sum(document.values()) for document in self.documents]
+        self.average_length = sum(self.lengths) / max(len(self.lengths), 1)
+        document_frequency = Counter(term for document in self.documents for term in document)
+        self.idf = {
+            term: math.log(1 + (len(tools) - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+
+    def score(self, terms, index):
+        document = self.documents[index]
+        norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / max(self.average_length, 1))
+        return sum(
+            self.idf[term] * document[term] * (self.k1 + 1) / (document[term] + norm)
+            for term in terms if term in document
+        )
+
+    def count_matches(self, query, ratio=0.5):
+        # Tools scoring close to the best match are the ones a request is likely to need
+        terms = set(tokenize(query))
+        scores = [self.score(terms, index) for index in range(len(self.tools))]
+        best = max(scores, default=0)
+        return sum(1 for score in scores if score > 0 and score >= ratio * best)
+
+    def search(self, query, top_k):
+        terms = set(tokenize(query))
+        scores = [self.score(terms, index) for index in range(len(self.tools))]
+        ranked = sorted(range(len(self.tools)), key=lambda index: scores[index], reverse=True)[:top_k]
+        if not any(scores[index] > 0 for index in ranked):
+            return list(self.tools)
+        # Keep the original tool order so prompts stay stable for the same selection
+        return [self.tools[index] for index in sorted(index for index in ranked if scores[index] > 0)]
+
+class ToolResultCache:
+    """TTL and LRU bounded cache for read-only tool results, coalescing identical in-flight calls."""
+
+    def __init__(self, ttls, max_entries=256):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.in_flight = {}
+
+    @staticmethod
+    def make_key(tool_name, arguments):
+        return f"{tool_name}:{json.dumps(arguments, sort_keys=True, separators=(',', ':'), default=str)}"
+
+    async def call(self, tool_name, coroutine, arguments):
+        key = self.make_key(tool_name, arguments)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            return entry[1]
+        if key in self.in_flight:
+            return await asyncio.shield(self.in_flight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            result = await coroutine(**arguments)
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when no other call was waiting on it
+            future.exception()
+            raise
+        finally:
+            self.in_flight.pop(key, None)
+        self.entries[key] = (time.monotonic() + self.ttls[tool_name], result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        future.set_result(result)
+        return result
+
+    def wrap(self, tool):
+        if tool.name not in self.ttls:
+            return tool
+        coroutine = tool.coroutine
+        async def cached_call(**arguments):
+            return await self.call(tool.name, coroutine, arguments)
+        return tool.model_copy(update={"coroutine": cached_call})
+
+# The mention a worker is handling, so tool output can be reduced to the parts relevant to it
+current_mention = ContextVar("current_mention", default=None)
+
+def truncate_bytes(text, max_bytes):
+    return text.encode()[:max(max_bytes, 0)].decode(errors="ignore")
+
+def split_chunks(text, chunk_bytes):
+    chunks, current = [], ""
+    for paragraph in re.split(r"(?<=\n)\n+", text):
+        while len(paragraph.encode()) > chunk_bytes:
+            head = truncate_bytes(paragraph, chunk_bytes)
+            chunks.append(head)
+            paragraph = paragraph[len(head):]
+        if current and len((current + paragraph).encode()) > chunk_bytes:
+            chunks.append(current)
+            current = ""
+        current += paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+def extract_chunks(text, query, max_bytes, chunk_bytes):
+    chunks = split_chunks(text, chunk_bytes)
+    terms = set(tokenize(query))
+    documents = [Counter(tokenize(chunk)) for chunk in chunks]
+    document_frequency = Counter(term for document in documents for term in terms if term in document)
+    scores = [
+        sum(math.log(1 + len(chunks) / document_frequency[term]) * math.log(1 + document[term])
+            for term in terms if term in document)
+        for document in documents
+    ]
+    selected, used = [], 0
+    for index in sorted(range(len(chunks)), key=lambda index: scores[index], reverse=True):
+        size = len(chunks[index].encode())
+        if scores[index] > 0 and used + size <= max_bytes:
+            selected.append(index)
+            used += size
+    # Keep document order so the model reads the extract as it was written
+    return [chunks[index] for index in sorted(selected)]
+
+class OutputStore:
+    """Local files holding full tool outputs that were cut down, read back a page at a time."""
+
+    def __init__(self, store_dir=".coral_outputs", max_entries=200, page_bytes=8000):
+        self.store_dir = store_dir
+        self.max_entries = max_entries
+        self.page_bytes = page_bytes
+
+    def get_path(self, output_id):
+        if not re.fullmatch(r"[0-9a-f]{16}", output_id or ""):
+            raise ToolException(f"Unknown tool output id: {output_id}")
+        return os.path.join(self.store_dir, f"{output_id}.txt")
+
+    def put(self, text):
+        os.makedirs(self.store_dir, exist_ok=True)
+        output_id = hashlib.sha256(text.encode()).hexdigest()[:16]
+        path = self.get_path(output_id)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+            self.evict()
+        return output_id
+
+    def evict(self):
+        try:
+            entries = [entry for entry in os.scandir(self.store_dir) if entry.name.endswith(".txt")]
+        except OSError:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in entries[self.max_entries:]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def count_pages(self, text):
+        return max(1, math.ceil(len(text.encode()) / self.page_bytes))
+
+    def read_page(self, output_id, page):
+        try:
+            with open(self.get_path(output_id), "r") as f:
+                text = f.read()
+        except OSError:
+            raise ToolException(f"Tool output {output_id} is no longer stored")
+        data = text.encode()
+        pages = self.count_pages(text)
+        page = min(max(page, 1), pages)
+        content = data[(page - 1) * self.page_bytes:page * self.page_bytes].decode(errors="ignore")
+        return f"[Tool output {output_id}, page {page} of {pages}]\n{content}"
+
+    def create_tool(self):
+        async def read_tool_output(output_id: str, page: int = 1) -> str:
+            return await asyncio.to_thread(self.read_page, output_id, page)
+        return StructuredTool.from_function(
+            coroutine=read_tool_output,
+            name="read_tool_output",
+            description=(
+                "Read one page of a large tool output that was shortened in an earlier tool result. "
+                "Pass the output_id given in that result and a page number starting at 1."
+            )
+        )
+
+class ToolOutputPolicy:
+    """Caps the size of tool results in the prompt and spills the full output to an OutputStore.
+
+    Each tool gets a byte and an approximate token cap and a mode: "truncate" keeps the head,
+    "head_tail" keeps the head and the tail, and "chunk" keeps the chunks most relevant to the
+    mention and the tool arguments.
+    """
+
+    MODES = ("truncate", "head_tail", "chunk")
+
+    def __init__(self, settings, store):
+        self.defaults = {key: value for key, value in settings.items() if key != "tools"}
+        self.tools = settings.get("tools", {})
+        self.store = store
+
+    def get_limits(self, tool_name):
+        limits = dict(self.defaults, **self.tools.get(tool_name, {}))
+        caps = [limits[key] for key in ("maxBytes",) if limits.get(key)]
+        if limits.get("maxTokens"):
+            # Roughly four bytes per token for English text and JSON
+            caps.append(limits["maxTokens"] * 4)
+        mode = limits.get("mode", "head_tail")
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown tool output mode for {tool_name}: {mode}")
+        return (min(caps) if caps else None), mode, limits.get("chunkBytes", 2000)
+
+    def reduce(self, text, max_bytes, mode, chunk_bytes, query):
+        if mode == "chunk":
+            chunks = extract_chunks(text, query, max_bytes, chunk_bytes)
+            if chunks:
+                return "\n[...]\n".join(chunks)
+        if mode in ("head_tail", "chunk"):
+            head = truncate_bytes(text, max_bytes * 2 // 3)
+            tail = text.encode()[-(max_bytes - len(head.encode())):].decode(errors="ignore")
+            return f"{head}\n[...]\n{tail}"
+        return truncate_bytes(text, max_bytes)
+
+    async def limit(self, tool_name, content, arguments):
+        max_bytes, mode, chunk_bytes = self.get_limits(tool_name)
+        text = content if isinstance(content, str) else "\n".join(str(item) for item in content)
+        size = len(text.encode())
+        if max_bytes is None or size <= max_bytes:
+            return content
+        mention = current_mention.get()
+        query = " ".join([mention["content"] if mention else ""] + [str(value) for value in arguments.values()])
+        output_id = await asyncio.to_thread(self.store.put, text)
+        reduced = self.reduce(text, max_bytes, mode, chunk_bytes, query)
+        metrics.increment("coral_tool_output_limited_total", tool=tool_name, mode=mode)
+        metrics.increment("coral_tool_output_bytes_saved_total", size - len(reduced.encode()), tool=tool_name)
+        return (
+            f"{reduced}\n[Output of {tool_name} shortened from {size} to about {max_bytes} bytes ({mode}). "
+            f"The full output is stored as {output_id} with {self.store.count_pages(text)} pages; "
+            f"call read_tool_output with this output_id and a page number to read more.]"
+        )
+
+    def wrap(self, tool):
+        if self.get_limits(tool.name)[0] is None:
+            return tool
+        coroutine = tool.coroutine
+        async def limited_call(**arguments):
+            content, artifact = await coroutine(**arguments)
+            return await self.limit(tool.name, content, arguments), artifact
+        return tool.model_copy(update={"coroutine": limited_call})
+
+class SharedTransport(httpx.AsyncBaseTransport):
+    """Delegates to pooled transports without closing them when one client is closed.
+
+    Long-lived event streams (GET requests accepting text/event-stream) go to stream_transport, so
+    an open Coral or MCP stream never holds a connection that a tool call is waiting for.
+    """
+
+    def __init__(self, transport, stream_transport=None):
+        self.transport = transport
+        self.stream_transport = stream_transport or transport
+
+    async def handle_async_request(self, request):
+        if request.method == "GET" and "text/event-stream" in request.headers.get("accept", ""):
+            return await self.stream_transport.handle_async_request(request)
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        pass
+
+class SharedHttpPool:
+    """httpx client factory for MCP connections whose clients share one keep-alive connection pool.
+
+    max_connections bounds the requests in flight. Each open session's event stream gets a
+    connection of its own outside that limit.
+    """
+
+    def __init__(self, max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0):
+        self.transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        ))
+        self.stream_transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(
+            max_connections=None,
+            max_keepalive_connections=0
+        ))
+
+    def __call__(self, headers=None, timeout=None, auth=None):
+        return httpx.AsyncClient(
+            transport=SharedTransport(self.transport, self.stream_transport),
+            headers=headers,
+            timeout=timeout or httpx.Timeout(30.0),
+            auth=auth,
+            follow_redirects=True
+        )
+
+    async def aclose(self):
+        await asyncio.gather(self.transport.aclose(), self.stream_transport.aclose())
+
+# MCP transports served over HTTP, whose connections go through a SharedHttpPool
+HTTP_TRANSPORTS = ("sse", "streamable_http")
+
+def expand_env(value, env):
+    # Remote MCP servers take credentials as ${VAR} references, e.g. in an Authorization header
+    if isinstance(value, str):
+        return re.sub(r"\$\{(\w+)\}", lambda match: env.get(match.group(1)) or "", value)
+    if isinstance(value, dict):
+        return {key: expand_env(item, env) for key, item in value.items()}
+    if isinstance(value, list):
+        return [expand_env(item, env) for item in value]
+    return value
+
+def create_http_pool(env, settings=None):
+    settings = AGENT_SETTINGS.get("httpPool", {}) if settings is None else settings
+    return SharedHttpPool(
+        int(env.get("CORAL_MCP_MAX_CONNECTIONS", settings.get("maxConnections", 20))),
+        int(env.get("CORAL_MCP_MAX_KEEPALIVE", settings.get("maxKeepalive", 10))),
+        float(env.get("CORAL_MCP_KEEPALIVE_EXPIRY", settings.get("keepaliveExpiry", 30.0)))
+    )
+
+class Backoff:
+    """Exponential backoff with jitter, so agents that lose the same server do not retry in lockstep."""
+
+    def __init__(self, base_delay=1.0, max_delay=60.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        # Cap the exponent so a long outage cannot overflow the float
+        delay = min(self.max_delay, self.base_delay * 2 ** min(attempt, 32))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+class CircuitOpenError(ToolException):
+    pass
+
+class CircuitBreaker:
+    """Opens after consecutive connection failures to a server and fails calls fast until reset_timeout passes."""
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def retry_in(self):
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def is_open(self):
+        return self.retry_in() > 0
+
+    def check(self):
+        # Once reset_timeout has passed the breaker is half open and lets calls through;
+        # the next failure opens it again
+        if self.is_open():
+            raise CircuitOpenError(f"{self.name} is unavailable, retry in {self.retry_in():.0f}s")
+
+    def record_success(self):
+        if self.opened_at is not None:
+            print(f"Circuit for {self.name} closed")
+            metrics.increment("coral_circuit_transitions_total", server=self.name, state="closed")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if not self.is_open():
+                print(f"Circuit for {self.name} opened after {self.failures} failures")
+                metrics.increment("coral_circuit_transitions_total", server=self.name, state="open")
+            self.opened_at = time.monotonic()
+
+def is_connection_error(error):
+    if isinstance(error, McpError):
+        return error.error.code == CONNECTION_CLOSED
+    return isinstance(error, (OSError, EOFError, asyncio.TimeoutError, httpx.TransportError,
+                              anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream))
+
+class McpSession:
+    """Holds one MCP server session open in a background task and serves its tools through proxies.
+
+    The task pings the server and rebuilds the session with backoff when it dies, so the proxies keep
+    working across reconnects. With a tool snapshot the proxies exist before the server has started.
+    Calls wait for the session to be ready unless the server's circuit breaker is open, and at most
+    max_concurrent_calls run at once (0 for no limit).
+    """
+
+    def __init__(self, client, server_name, snapshot=None, connect_timeout=120.0, ping_interval=30.0,
+                 backoff=None, breaker=None, max_concurrent_calls=0):
+        self.client = client
+        self.server_name = server_name
+        self.snapshot = snapshot
+        self.connect_timeout = connect_timeout
+        self.ping_interval = ping_interval
+        self.backoff = backoff or Backoff()
+        self.breaker = breaker or CircuitBreaker(server_name)
+        self.call_limit = asyncio.Semaphore(max_concurrent_calls) if max_concurrent_calls > 0 else None
+        self.ready = asyncio.Event()
+        self.lost = asyncio.Event()
+        self.state_changed = asyncio.Event()
+        self.live_tools = {}
+        self.generation = 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    def notify(self):
+        # Wake every call waiting for the session so it re-checks the state and the breaker
+        self.state_changed.set()
+        self.state_changed = asyncio.Event()
+
+    def mark_lost(self, generation):
+        # Ignore failures from calls made on a session that was already replaced
+        if generation == self.generation:
+            self.lost.set()
+
+    async def run(self):
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            self.lost.clear()
+            try:
+                # The session is entered and exited in this task, as the stdio transport requires.
+                # A server that never finishes starting counts as a failed connect
+                async with AsyncExitStack() as stack:
+                    async with asyncio.timeout(self.connect_timeout):
+                        session = await stack.enter_async_context(self.client.session(self.server_name))
+                        tools = await load_mcp_tools(session)
+                    self.live_tools = {tool.name: tool for tool in tools}
+                    self.generation += 1
+                    metrics.observe("coral_phase_seconds", time.perf_counter() - started, phase="mcp_connect",
+                                    server=self.server_name)
+                    print(f"Connected to MCP server {self.server_name} with {len(tools)} tools")
+                    attempt = 0
+                    self.breaker.record_success()
+                    self.ready.set()
+                    self.notify()
+                    await self.watch(session)
+                    self.ready.clear()
+                print(f"MCP session {self.server_name} was lost")
+            except TimeoutError:
+                self.breaker.record_failure()
+                print(f"MCP session {self.server_name} did not start within {self.connect_timeout}s")
+            except Exception as e:
+                self.breaker.record_failure()
+                print(f"MCP session {self.server_name} failed: {str(e)}")
+                print(traceback.format_exc())
+            self.ready.clear()
+            self.notify()
+            metrics.increment("coral_reconnects_total", server=self.server_name)
+            delay = self.backoff.delay(attempt)
+            attempt += 1
+            print(f"Reconnecting to {self.server_name} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def watch(self, session):
+        while True:
+            try:
+                await asyncio.wait_for(self.lost.wait(), self.ping_interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await asyncio.wait_for(session.send_ping(), min(self.ping_interval, 10))
+            except McpError as e:
+                # Any answer other than a closed connection means the server is still there
+                if e.error.code == CONNECTION_CLOSED:
+                    return
+            except Exception as e:
+                print(f"Ping to {self.server_name} failed: {str(e) or type(e).__name__}")
+                return
+
+    async def wait_ready(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while not self.ready.is_set():
+            self.breaker.check()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ToolException(f"MCP server {self.server_name} is not connected after {self.connect_timeout}s")
+            try:
+                await asyncio.wait_for(self.state_changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def live_fingerprint(self):
+        return tools_fingerprint(self.live_tools.values())
+
+    async def call(self, name, arguments):
+        if self.call_limit is None:
+            return await self.call_tool(name, arguments)
+        with metrics.timer("coral_phase_seconds", phase="tool_slot_wait", server=self.server_name):
+            await self.call_limit.acquire()
+        try:
+            return await self.call_tool(name, arguments)
+        finally:
+            self.call_limit.release()
+
+    async def call_tool(self, name, arguments):
+        await self.wait_ready()
+        generation = self.generation
+        tool = self.live_tools.get(name)
+        if tool is None:
+            raise ToolException(f"Tool {name} is no longer provided by {self.server_name}")
+        try:
+            return await tool.coroutine(**arguments)
+        except Exception as e:
+            if not is_connection_error(e):
+                raise
+            self.breaker.record_failure()
+            self.mark_lost(generation)
+            raise ToolException(f"Lost the connection to {self.server_name} during {name}: {str(e)}") from e
+
+    def create_proxy(self, name, description, schema):
+        async def call_tool(**arguments):
+            return await self.call(name, arguments)
+        return StructuredTool(name=name, description=description, args_schema=schema, coroutine=call_tool,
+                              response_format="content_and_artifact")
+
+    def snapshot_tools(self):
+        return [self.create_proxy(tool["name"], tool["description"], tool["schema"]) for tool in self.snapshot["tools"]]
+
+    def get_tools(self):
+        return [self.create_proxy(tool.name, tool.description, get_tool_schema(tool)) for tool in self.live_tools.values()]
+
+    async def aclose(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+def create_session(client, server_name, env, snapshot=None, max_concurrent_calls=0):
+    return McpSession(
+        client, server_name, snapshot,
+        connect_timeout=float(env.get("CORAL_MCP_CONNECT_TIMEOUT", "120")),
+        ping_interval=float(env.get("CORAL_PING_INTERVAL", "30")),
+        backoff=create_backoff(env),
+        breaker=CircuitBreaker(server_name, int(env.get("CORAL_BREAKER_FAILURES", "3")),
+                               float(env.get("CORAL_BREAKER_RESET", "30"))),
+        max_concurrent_calls=max_concurrent_calls
+    ).start()
+
+def create_backoff(env):
+    return Backoff(float(env.get("CORAL_RETRY_BASE_DELAY", "1")), float(env.get("CORAL_RETRY_MAX_DELAY", "60")))
+
+class AgentToolset:
+    """The agent tools currently served, with their search index. Replacing them bumps the version.
+
+    The index is built by build_index, or on first use, and rebuilt when the tools are replaced.
+    Pinned tools are local to the runtime and offered with every selection.
+    """
+
+    def __init__(self, tools, pinned_tools=()):
+        self.tools = tools
+        self.pinned_tools = list(pinned_tools)
+        self.version = 0
+        self.index = None
+
+    def replace(self, tools):
+        indexed = self.index is not None
+        self.tools = tools
+        self.index = None
+        self.version += 1
+        if indexed:
+            self.build_index()
+
+    def all_tools(self):
+        return self.tools + self.pinned_tools
+
+    def build_index(self):
+        self.index = ToolIndex(self.tools)
+        return self.index
+
+    def get_index(self):
+        return self.index if self.index is not None else self.build_index()
+
+    def search(self, query, top_k):
+        if not 0 < top_k < len(self.tools):
+            return self.all_tools()
+        return self.get_index().search(query, top_k) + self.pinned_tools
+
+async def follow_live_schemas(mcp_session, toolset, prepare_tools, fingerprint, generation=0):
+    # Every reconnect rebuilds the session, so a server upgraded in the meantime may serve new schemas
+    while True:
+        while mcp_session.generation == generation or not mcp_session.ready.is_set():
+            await mcp_session.state_changed.wait()
+        generation = mcp_session.generation
+        live_fingerprint = mcp_session.live_fingerprint()
+        if live_fingerprint == fingerprint:
+            continue
+        if mcp_session.snapshot is not None and fingerprint == mcp_session.snapshot["fingerprint"]:
+            print(f"Tool schemas of {mcp_session.server_name} changed since the coraliser snapshot, "
+                  "switching to the live schemas. Re-run the coraliser to refresh the snapshot.")
+        else:
+            print(f"Tool schemas of {mcp_session.server_name} changed after reconnecting, switching to the new schemas")
+        toolset.replace(prepare_tools(mcp_session.get_tools()))
+        fingerprint = live_fingerprint
+
+class SessionRecorder:
+    """Appends mentions, model calls and agent tool calls to a JSONL log for offline replay. Disabled by default.
+
+    Every event has its offset in seconds from the start of the recording and the id of the mention
+    being handled. Messages sent to the model are written once and then referenced by hash, so the
+    system prompt and earlier turns are not repeated in every request.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.file = None
+        self.started = time.perf_counter()
+        self.mentions = 0
+        self.messages = set()
+        self.callbacks = []
+
+    def configure(self, path=None):
+        if self.file is not None:
+            self.file.close()
+        self.enabled = bool(path)
+        self.file = open(path, "a", buffering=1) if self.enabled else None
+        self.started = time.perf_counter()
+        self.mentions = 0
+        self.messages = set()
+        self.callbacks = [RecorderCallbackHandler(self)] if self.enabled else []
+        if self.enabled:
+            print(f"Recording mentions, model calls and tool calls to {path}")
+        return self.enabled
+
+    def write(self, kind, mention=None, **fields):
+        if not self.enabled:
+            return
+        mention = mention or current_mention.get()
+        event = {"t": round(time.perf_counter() - self.started, 6), "type": kind,
+                 "mention": mention.get("record_id") if mention else None, **fields}
+        self.file.write(json.dumps(event, separators=(",", ":"), default=str) + "\n")
+
+    def record_session(self, env, tools):
+        self.write("session", agent_id=env.get("CORAL_AGENT_ID"), model=env.get("MODEL_NAME", "gpt-4.1-mini"),
+                   settings=AGENT_SETTINGS, started=time.time(),
+                   tools=[{"name": tool.name, "description": tool.description, "schema": get_tool_schema(tool)}
+                          for tool in tools])
+
+    def record_mention(self, mention):
+        if not self.enabled:
+            return
+        self.mentions += 1
+        mention["record_id"] = self.mentions
+        self.write("mention", mention, message_id=mention["message_id"], thread_id=mention["thread_id"],
+                   sender_id=mention["sender_id"], content=mention["content"])
+
+    def message_refs(self, messages):
+        refs = []
+        size = 0
+        for message in messages:
+            data = message_to_dict(message)
+            encoded = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+            ref = hashlib.sha256(encoded.encode()).hexdigest()[:16]
+            if ref not in self.messages:
+                self.messages.add(ref)
+                self.write("message", id=ref, data=data)
+            refs.append(ref)
+            size += len(encoded.encode())
+        return refs, size
+
+    def wrap(self, tool):
+        coroutine = tool.coroutine
+        async def recorded_call(**arguments):
+            started = time.perf_counter()
+            try:
+                content, artifact = await coroutine(**arguments)
+            except Exception as e:
+                self.write("tool", name=tool.name, arguments=arguments, seconds=time.perf_counter() - started,
+                           error=str(e))
+                raise
+            self.write("tool", name=tool.name, arguments=arguments, seconds=time.perf_counter() - started,
+                       content=content)
+            return content, artifact
+        return tool.model_copy(update={"coroutine": recorded_call})
+
+class RecorderCallbackHandler(AsyncCallbackHandler):
+    """Writes each model request and response to a SessionRecorder."""
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.runs = {}
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id, invocation_params=None, **kwargs):
+        params = invocation_params or {}
+        model = params.get("model") or params.get("model_name") or (serialized or {}).get("name", "model")
+        refs, size = self.recorder.message_refs(messages[0])
+        self.runs[run_id] = (model, time.perf_counter())
+        self.recorder.write("model_request", run=str(run_id), model=model, messages=refs, bytes=size,
+                            tools=len(params.get("tools") or []))
+
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        model, started = self.runs.pop(run_id, ("model", time.perf_counter()))
+        generation = response.generations[0][0]
+        message = getattr(generation, "message", None)
+        self.recorder.write("model_response", run=str(run_id), model=model, seconds=time.perf_counter() - started,
+                            message=message_to_dict(message) if message is not None else
+                            {"type": "ai", "data": {"content": generation.text}})
+
+    async def on_llm_error(self, error, *, run_id, **kwargs):
+        model, started = self.runs.pop(run_id, ("model", time.perf_counter()))
+        self.recorder.write("model_response", run=str(run_id), model=model, seconds=time.perf_counter() - started,
+                            error=str(error))
+
+recorder = SessionRecorder()
+
+class RateLimiter(BaseRateLimiter):
+    """Token buckets for model requests and tokens per minute, used as a chat model's rate_limiter.
+
+    With a state_file the buckets live in that file under an exclusive lock, so every process using
+    the same file shares one budget. Background callers only draw while a bucket holds more than
+    `reserve` of its capacity, which leaves headroom for interactive callers. Tokens are charged
+    after each call by RateLimitCallbackHandler, so a bucket may go negative and delay later calls.
+    """
+
+    PRIORITIES = ("interactive", "background")
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, priority="interactive", reserve=0.2,
+                 state_file=None, burst_seconds=10.0):
+        if priority not in self.PRIORITIES:
+            raise ValueError(f"Unknown rate limit priority: {priority}")
+        self.rates = {
+            name: rate for name, rate in (("requests", requests_per_minute), ("tokens", tokens_per_minute)) if rate > 0
+        }
+        self.capacities = {name: max(rate * burst_seconds / 60, 1) for name, rate in self.rates.items()}
+        self.priority = priority
+        self.reserve = reserve if priority == "background" else 0.0
+        if state_file and fcntl is None:
+            print("File locks are not available on this platform, rate limits apply to this process only")
+            state_file = None
+        self.state_file = state_file or None
+        self.state = {}
+        self.lock = threading.Lock()
+
+    def update(self, change):
+        # Applies change(buckets) to the refilled buckets and returns its result
+        with self.lock:
+            if self.state_file is None:
+                return change(self.refill(self.state))
+            with open(self.state_file, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read() or "{}")
+                    except ValueError:
+                        state = {}
+                    result = change(self.refill(state))
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    return result
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def refill(self, state):
+        now = time.time()
+        for name, rate in self.rates.items():
+            bucket = state.setdefault(name, {"level": self.capacities[name], "updated": now})
+            elapsed = max(0.0, now - bucket["updated"])
+            bucket["level"] = min(self.capacities[name], bucket["level"] + elapsed * rate / 60)
+            bucket["updated"] = now
+        return state
+
+    def try_acquire(self, state):
+        # Returns 0 once a request is taken, otherwise the seconds until one could be
+        wait = 0.0
+        for name, rate in self.rates.items():
+            cost = 1 if name == "requests" else 0
+            # The reserve is held back from what is left after this request, so a small bucket can
+            # still fill up far enough for a background caller
+            needed = self.reserve * (self.capacities[name] - cost) + cost
+            if state[name]["level"] < needed or state[name]["level"] <= 0:
+                wait = max(wait, (max(needed, 0) - state[name]["level"]) * 60 / rate, 0.01)
+        if wait == 0.0 and "requests" in state:
+            state["requests"]["level"] -= 1
+        return wait
+
+    def charge(self, tokens):
+        if "tokens" in self.rates and tokens > 0:
+            self.update(lambda state: state["tokens"].update(level=state["tokens"]["level"] - tokens))
+
+    def drain(self):
+        # The provider throttled us anyway, so every process sharing the budget backs off
+        def empty(state):
+            for bucket in state.values():
+                bucket["level"] = min(bucket["level"], 0)
+        self.update(empty)
+
+    def acquire(self, *, blocking=True):
+        started = time.perf_counter()
+        while True:
+            wait = self.update(self.try_acquire)
+            if wait == 0.0 or not blocking:
+                break
+            time.sleep(min(wait, 5.0))
+        metrics.observe("coral_rate_limit_wait_seconds", time.perf_counter() - started, priority=self.priority)
+        return wait == 0.0
+
+    async def aacquire(self, *, blocking=True):
+        started = time.perf_counter()
+        while True:
+            wait = await asyncio.to_thread(self.update, self.try_acquire)
+            if wait == 0.0 or not blocking:
+                break
+            await asyncio.sleep(min(wait, 5.0) * random.uniform(1.0, 1.2))
+        metrics.observe("coral_rate_limit_wait_seconds", time.perf_counter() - started, priority=self.priority)
+        return wait == 0.0
+
+    def model_kwargs(self):
+        return {"rate_limiter": self, "callbacks": [RateLimitCallbackHandler(self)]}
+
+class RateLimitCallbackHandler(AsyncCallbackHandler):
+    """Charges the tokens of each model call to a RateLimiter, estimating them when usage is not reported."""
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.prompt_sizes = {}
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.prompt_sizes[run_id] = sum(len(str(message.content)) for batch in messages for message in batch)
+
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        prompt_size = self.prompt_sizes.pop(run_id, 0)
+        tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                # Roughly four characters per token when the provider does not report usage
+                tokens += usage.get("total_tokens") or (prompt_size + len(generation.text)) // 4
+        await asyncio.to_thread(self.limiter.charge, tokens)
+
+    async def on_llm_error(self, error, *, run_id, **kwargs):
+        self.prompt_sizes.pop(run_id, None)
+        if "429" in str(error) or "rate limit" in str(error).lower():
+            await asyncio.to_thread(self.limiter.drain)
+
+def create_rate_limiter(env=None, priority="interactive"):
+    env = env if env is not None else os.environ
+    requests_per_minute = float(env.get("MODEL_RPM", "0"))
+    tokens_per_minute = float(env.get("MODEL_TPM", "0"))
+    if requests_per_minute <= 0 and tokens_per_minute <= 0:
+        return None
+    return RateLimiter(requests_per_minute, tokens_per_minute, priority,
+                       float(env.get("MODEL_RATE_LIMIT_RESERVE", "0.2")), env.get("MODEL_RATE_LIMIT_FILE") or None)
+
+def create_model(env=None, priority="interactive", **kwargs):
+    env = env if env is not None else os.environ
+    rate_limiter = create_rate_limiter(env, priority)
+    if rate_limiter is not None:
+        kwargs.update(rate_limiter.model_kwargs())
+    return init_chat_model(
+            model=env.get("MODEL_NAME", "gpt-4.1-mini"),
+            model_provider=env.get("MODEL_PROVIDER", "openai"),
+            api_key=env.get("API_KEY"),
+            temperature=env.get("MODEL_TEMPERATURE", "0.1"),
+            max_tokens=env.get("MODEL_TOKEN", "8000"),
+            **kwargs
+        )
+
+# The runtime loop owns these coral tools in direct mode, so they are not bound to the model
+RUNTIME_CORAL_TOOLS = ("wait_for_mentions", "send_message")
+
+def get_tool(tools, name):
+    tool = next((tool for tool in tools if tool.name == name), None)
+    if tool is None:
+        raise RuntimeError(f"Coral server does not expose {name}")
+    return tool
+
+def create_mention_agent(coral_tools, agent_tools, model):
+    coral_tools = [tool for tool in coral_tools if tool.name not in RUNTIME_CORAL_TOOLS]
+    coral_tools_description = get_tools_description(coral_tools)
+    agent_tools_description = get_tools_description(agent_tools)
+    combined_tools = coral_tools + agent_tools
+    prompt = ChatPromptTemplate.from_messages([
+        (
+            "system",
+            f"""You are an agent interacting with the tools from Coral Server and having your own tools. Your task is to perform the instruction you received as a mention from another agent.
+            Follow these steps in order:
+            1. Think about the content (instruction) of the message and check only from the list of your tools available for you to action.
+            2. Check the tool schema and make a plan in steps for the task you want to perform.
+            3. Only call the tools you need to perform for each step of the plan to complete the instruction in the content.
+            4. Think about the content and see if you have executed the instruction to the best of your ability and the tools.
+            5. Make your final response the answer for the sender. It is sent back to the sender in the same thread for you, so do not wait for mentions or send messages yourself.
+            6. If you cannot complete the instruction, make your final response a short explanation of the error.
+
+            These are the list of coral tools: {coral_tools_description}
+            These are the list of your tools: {agent_tools_description}"""
+        ),
+        ("human", "Mention from {sender_id} in thread {thread_id}: {content}"),
+        ("placeholder", "{agent_scratchpad}")
+    ])
+    agent = create_tool_calling_agent(model, combined_tools, prompt)
+    return AgentExecutor(agent=agent, tools=combined_tools, verbose=True)
+
+async def dispatch_mentions(wait_for_mentions, queue, timeout_ms, backoff=None, coalescer=None):
+    backoff = backoff or Backoff()
+    failures = 0
+    while True:
+        try:
+            with metrics.timer("coral_phase_seconds", phase="wait_for_mentions"):
+                result = await wait_for_mentions.ainvoke({"timeoutMs": timeout_ms})
+            failures = 0
+        except Exception as e:
+            print(f"Error waiting for mentions: {str(e)}")
+            if not isinstance(e, CircuitOpenError):
+                print(traceback.format_exc())
+            await asyncio.sleep(backoff.delay(failures))
+            failures += 1
+            continue
+        for mention in parse_mentions(result):
+            mention["received_at"] = time.perf_counter()
+            recorder.record_mention(mention)
+            # Blocks once the queue is full so at most queue size mentions are in flight
+            await (coalescer or queue).put(mention)
+
+class MentionCoalescer:
+    """Collects mentions that arrive in the same thread within a window and queues them as one batch.
+
+    The window starts with the first mention in a thread. The batch is queued when the window ends
+    or when it holds max_mentions. A batch of one is queued as the plain mention.
+    """
+
+    def __init__(self, queue, window, max_mentions=5):
+        self.queue = queue
+        self.window = window
+        self.max_mentions = max_mentions
+        self.batches = {}
+        self.timers = {}
+
+    async def put(self, mention):
+        thread_id = mention["thread_id"]
+        batch = self.batches.setdefault(thread_id, [])
+        batch.append(mention)
+        if len(batch) >= self.max_mentions:
+            timer = self.timers.pop(thread_id, None)
+            if timer is not None:
+                timer.cancel()
+            await self.flush(thread_id)
+        elif len(batch) == 1:
+            self.timers[thread_id] = asyncio.create_task(self.flush_later(thread_id))
+
+    async def flush_later(self, thread_id):
+        await asyncio.sleep(self.window)
+        self.timers.pop(thread_id, None)
+        await self.flush(thread_id)
+
+    async def flush(self, thread_id):
+        batch = self.batches.pop(thread_id, [])
+        if len(batch) > 1:
+            metrics.increment("coral_mention_batches_total")
+            metrics.increment("coral_mentions_coalesced_total", len(batch))
+            print(f"Coalesced {len(batch)} mentions in thread {thread_id}")
+        if batch:
+            await self.queue.put(merge_mentions(batch))
+
+    def cancel(self):
+        for timer in self.timers.values():
+            timer.cancel()
+
+def create_coalescer(env, queue):
+    window = int(env.get("CORAL_COALESCE_WINDOW_MS", "0")) / 1000
+    if window <= 0:
+        return None
+    max_mentions = int(env.get("CORAL_COALESCE_MAX_MENTIONS", "5"))
+    print(f"Coalescing up to {max_mentions} mentions per thread arriving within {window}s")
+    return MentionCoalescer(queue, window, max_mentions)
+
+def merge_mentions(batch):
+    if len(batch) == 1:
+        return batch[0]
+    lines = [f"You received {len(batch)} mentions in this thread. Answer each of them separately, starting "
+             "each answer on a new line with the number of its mention in brackets, like [1]."]
+    lines.extend(f"[{number}] From {mention['sender_id']}: {mention['content']}"
+                 for number, mention in enumerate(batch, 1))
+    # The batch keeps the first mention's ids, so it is recorded and replayed under that mention
+    return dict(batch[0], content="\n".join(lines), batch=batch)
+
+def mention_text(mention):
+    # Routing and tool selection look at what the senders wrote, not at the batch instructions
+    return " ".join(item["content"] for item in mention.get("batch", [mention]))
+
+def split_replies(mention, answer):
+    batch = mention.get("batch")
+    if batch is None:
+        return [(mention, answer)]
+    parts = {}
+    pieces = re.split(r"(?m)^\s*\[(\d+)\]\s*", answer)
+    for number, text in zip(pieces[1::2], pieces[2::2]):
+        parts.setdefault(int(number), text.strip())
+    # A mention whose numbered answer is missing gets the whole answer
+    return [(item, parts.get(number) or answer) for number, item in enumerate(batch, 1)]
+
+async def send_reply(send_message, mention, content):
+    with metrics.timer("coral_phase_seconds", phase="send_message"):
+        await send_message.ainvoke({
+            "threadId": mention["thread_id"],
+            "content": content,
+            "mentions": list(dict.fromkeys(item["sender_id"] for item in mention.get("batch", [mention])))
+        })
+
+class ReplyStreamer(AsyncCallbackHandler):
+    """Sends a reply to its Coral thread in chunks while the agent runs, then a completion marker.
+
+    Model tokens and tool progress are buffered and sent once the buffer reaches chunk_bytes or
+    interval seconds have passed, whichever comes first. Chunks are sent in order by one task.
+    """
+
+    def __init__(self, send_message, mention, chunk_bytes=400, interval=1.5, end_marker="[END]"):
+        self.send_message = send_message
+        self.mention = mention
+        self.chunk_bytes = chunk_bytes
+        self.interval = interval
+        self.end_marker = end_marker
+        self.buffer = []
+        self.size = 0
+        self.wake = asyncio.Event()
+        self.closed = False
+        self.sent = 0
+        self.streamed_runs = set()
+        self.tool_runs = {}
+        self.last_text = ""
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    def write(self, text):
+        if not text:
+            return
+        self.buffer.append(text)
+        self.size += len(text.encode())
+        # The first chunk goes out straight away so the sender knows the work has started
+        if self.size >= self.chunk_bytes or self.sent == 0:
+            self.wake.set()
+
+    async def run(self):
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            if not self.closed:
+                await self.flush()
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        content = "".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        try:
+            await send_reply(self.send_message, self.mention, content)
+        except Exception as e:
+            print(f"Error streaming reply to thread {self.mention['thread_id']}: {str(e)}")
+            return
+        if self.sent == 0:
+            metrics.observe("coral_mention_first_reply_seconds", time.perf_counter() - self.mention["received_at"])
+        self.sent += 1
+
+    async def finish(self, answer):
+        self.closed = True
+        self.wake.set()
+        # Let a chunk that is being sent go out before the rest
+        await self.task
+        # The final answer was normally streamed as model tokens already
+        if answer.strip() != self.last_text.strip():
+            self.write(("\n" if self.buffer else "") + answer)
+        self.write(("\n" if self.buffer else "") + self.end_marker)
+        await self.flush()
+
+    async def on_llm_new_token(self, token, *, run_id, **kwargs):
+        if token:
+            if run_id not in self.streamed_runs:
+                self.streamed_runs.add(run_id)
+                self.last_text = ""
+            self.last_text += token
+            self.write(token)
+
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        if run_id in self.streamed_runs:
+            self.streamed_runs.discard(run_id)
+            return
+        # Models that do not stream still report each turn's text when it ends
+        text = "".join(generation.text for generations in response.generations for generation in generations)
+        self.last_text = text
+        self.write(text)
+
+    async def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        name = (serialized or {}).get("name", "tool")
+        self.tool_runs[run_id] = (name, time.perf_counter())
+        self.write(f"\n[{name} running]\n")
+
+    async def on_tool_end(self, output, *, run_id, **kwargs):
+        name, started = self.tool_runs.pop(run_id, ("tool", time.perf_counter()))
+        self.write(f"[{name} finished in {time.perf_counter() - started:.1f}s]\n")
+
+    async def on_tool_error(self, error, *, run_id, **kwargs):
+        name, started = self.tool_runs.pop(run_id, ("tool", time.perf_counter()))
+        self.write(f"[{name} failed: {str(error)}]\n")
+
+# Words that suggest a mention needs several steps or more reasoning
+ROUTING_KEYWORDS = ("then", "after", "compare", "analyze", "analyse", "summarize", "summarise", "review",
+                    "investigate", "plan", "explain", "why", "each", "every", "report", "crawl")
+
+class ModelRouter:
+    """Picks the fast or the strong model for each mention with cheap local heuristics.
+
+    A mention goes to the strong model when it is long, uses a multi-step keyword or matches
+    more than max_tools agent tools; everything else goes to the fast model. A fast attempt
+    that raises or gives no answer is escalated to the strong model, unless it already called
+    a tool outside read_only_tools, since the strong model would run that tool again.
+    """
+
+    def __init__(self, toolset, max_words=40, max_tools=3, keywords=ROUTING_KEYWORDS, read_only_tools=()):
+        self.toolset = toolset
+        self.max_words = max_words
+        self.max_tools = max_tools
+        self.keywords = set(tokenize(" ".join(keywords)))
+        self.read_only_tools = set(read_only_tools)
+
+    def classify(self, content):
+        if len(content.split()) > self.max_words:
+            return "strong", "long"
+        if self.keywords & set(tokenize(content)):
+            return "strong", "keywords"
+        if self.toolset.tools and self.toolset.get_index().count_matches(content) > self.max_tools:
+            return "strong", "tools"
+        return "fast", "simple"
+
+    def failed(self, result):
+        output = str(result.get("output") or "").strip()
+        return not output or output.startswith("Agent stopped")
+
+    def can_escalate(self, called_tools):
+        return set(called_tools) <= self.read_only_tools
+
+class ToolCallTracker(AsyncCallbackHandler):
+    """Collects the names of the tools called during one agent run."""
+
+    def __init__(self):
+        self.tools = set()
+
+    async def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self.tools.add((serialized or {}).get("name", "tool"))
+
+def create_router(env, toolset):
+    if not env.get("MODEL_FAST_NAME"):
+        return None
+    settings = AGENT_SETTINGS.get("modelRouting", {})
+    router = ModelRouter(
+        toolset,
+        int(env.get("CORAL_ROUTE_MAX_WORDS", settings.get("maxWords", 40))),
+        int(env.get("CORAL_ROUTE_MAX_TOOLS", settings.get("maxTools", 3))),
+        settings.get("keywords", ROUTING_KEYWORDS),
+        # Tools listed for caching are read-only, so a fast attempt that only used them can be repeated
+        set(AGENT_SETTINGS.get("toolCache", {}).get("tools", {})) | set(settings.get("readOnlyTools", []))
+        | {"read_tool_output", "list_agents"}
+    )
+    print(f"Routing simple mentions to {env.get('MODEL_FAST_NAME')}, others to {env.get('MODEL_NAME', 'gpt-4.1-mini')}")
+    return router
+
+FAST_MODEL_ENV = {
+    "MODEL_FAST_NAME": "MODEL_NAME",
+    "MODEL_FAST_PROVIDER": "MODEL_PROVIDER",
+    "MODEL_FAST_API_KEY": "API_KEY",
+    "MODEL_FAST_TOKEN": "MODEL_TOKEN",
+    "MODEL_FAST_TEMPERATURE": "MODEL_TEMPERATURE",
+}
+
+def create_fast_model(env):
+    # The fast model falls back to the main model's provider, key and limits
+    fast_env = dict(env)
+    fast_env.update({key: env[fast_key] for fast_key, key in FAST_MODEL_ENV.items() if env.get(fast_key)})
+    return create_model(fast_env)
+
+async def invoke_agent(agent_executor, mention, callbacks, route):
+    with metrics.timer("coral_phase_seconds", phase="agent_invocation", route=route):
+        return await agent_executor.ainvoke({
+            "thread_id": mention["thread_id"],
+            "sender_id": mention["sender_id"],
+            "content": mention["content"],
+            "agent_scratchpad": []
+        }, config={"callbacks": callbacks})
+
+def create_streamer_factory(env, send_message):
+    if env.get("CORAL_REPLY_MODE", "final") != "stream":
+        return None
+    chunk_bytes = int(env.get("CORAL_STREAM_CHUNK_BYTES", "400"))
+    interval = int(env.get("CORAL_STREAM_INTERVAL_MS", "1500")) / 1000
+    end_marker = env.get("CORAL_STREAM_END_MARKER", "[END]")
+    print(f"Streaming replies in chunks of {chunk_bytes} bytes or {interval}s, ending with {end_marker}")
+    return lambda mention: ReplyStreamer(send_message, mention, chunk_bytes, interval, end_marker).start()
+
+async def mention_worker(worker_id, queue, get_executor, send_message, breaker=None, create_streamer=None,
+                         router=None):
+    while True:
+        mention = await queue.get()
+        streamer = None
+        try:
+            print(f"Worker {worker_id} handling mention from {mention['sender_id']} in thread {mention['thread_id']}")
+            metrics.observe("coral_phase_seconds", time.perf_counter() - mention["received_at"], phase="queue_wait")
+            current_mention.set(mention)
+            try:
+                # Answer straight away while the agent's MCP server is down instead of spending a model call
+                if breaker is not None:
+                    breaker.check()
+                callbacks = metrics.callbacks + recorder.callbacks
+                if create_streamer is not None:
+                    streamer = create_streamer(mention)
+                    callbacks = callbacks + [streamer]
+                route, reason = router.classify(mention_text(mention)) if router is not None else ("strong", "default")
+                metrics.increment("coral_model_routes_total", route=route, reason=reason)
+                result = None
+                if route == "fast":
+                    print(f"Worker {worker_id} routed mention to the fast model")
+                    tracker = ToolCallTracker()
+                    failure = None
+                    try:
+                        result = await invoke_agent(get_executor(mention, "fast"), mention, callbacks + [tracker],
+                                                    "fast")
+                    except CircuitOpenError:
+                        raise
+                    except Exception as e:
+                        print(f"Fast model attempt failed in worker {worker_id}: {str(e)}")
+                        failure = e
+                    if (result is None or router.failed(result)) and not router.can_escalate(tracker.tools):
+                        # Running the mention again would repeat tools that may have changed something
+                        print(f"Worker {worker_id} not escalating, the fast model already called "
+                              f"{', '.join(sorted(tracker.tools - router.read_only_tools))}")
+                        metrics.increment("coral_model_escalations_skipped_total")
+                        if failure is not None:
+                            raise failure
+                    elif result is None or router.failed(result):
+                        print(f"Worker {worker_id} escalating mention to the strong model")
+                        metrics.increment("coral_model_escalations_total")
+                        if streamer is not None:
+                            streamer.write("\n[escalating to the strong model]\n")
+                        result = None
+                if result is None:
+                    result = await invoke_agent(get_executor(mention, "strong"), mention, callbacks, "strong")
+                answer = str(result.get("output") or "No answer")
+            except Exception as e:
+                print(f"Error in worker {worker_id}: {str(e)}")
+                if not isinstance(e, CircuitOpenError):
+                    print(traceback.format_exc())
+                answer = f"error: {str(e)}"
+            if streamer is not None:
+                # A streamed batch goes to the thread as one reply to all of its senders
+                await streamer.finish(answer)
+                replies = [(item, answer) for item in mention.get("batch", [mention])]
+            else:
+                replies = split_replies(mention, answer)
+                for item, reply in replies:
+                    await send_reply(send_message, item, reply)
+            for item, reply in replies:
+                metrics.observe("coral_mention_reply_seconds", time.perf_counter() - item["received_at"])
+                recorder.write("reply", item, seconds=time.perf_counter() - item["received_at"],
+                               bytes=len(reply.encode()))
+            print(f"Worker {worker_id} replied to {mention['sender_id']} in thread {mention['thread_id']}")
+        except Exception as e:
+            print(f"Error replying from worker {worker_id}: {str(e)}")
+            print(traceback.format_exc())
+        finally:
+            if streamer is not None and not streamer.task.done():
+                streamer.task.cancel()
+            queue.task_done()
+
+def create_executor_factory(coral_tools, toolset, models, top_k=0):
+    executors = {}
+    version = None
+    def get_executor(mention, route="strong"):
+        nonlocal version
+        if version != toolset.version:
+            # The toolset was replaced with the live schemas, so drop executors built on the old ones
+            executors.clear()
+            version = toolset.version
+        selected_tools = toolset.search(mention_text(mention), top_k)
+        names = tuple(tool.name for tool in selected_tools)
+        key = (route, names)
+        if key not in executors:
+            if len(executors) >= 64:
+                executors.pop(next(iter(executors)))
+            executors[key] = create_mention_agent(coral_tools, selected_tools, models[route])
+        if 0 < top_k < len(toolset.tools):
+            print(f"Selected tools for mention: {', '.join(names)}")
+        return executors[key]
+    return get_executor
+
+async def run_worker_pool(coral_tools, toolset, models, max_concurrency, max_queue_size, timeout_ms, top_k=0,
+                          backoff=None, breaker=None, env=None, router=None):
+    wait_for_mentions = get_tool(coral_tools, "wait_for_mentions")
+    send_message = get_tool(coral_tools, "send_message")
+    if 0 < top_k < len(toolset.tools):
+        print(f"Indexing {len(toolset.tools)} agent tools, selecting the top {top_k} per mention")
+        with metrics.timer("coral_phase_seconds", phase="tool_index"):
+            toolset.build_index()
+    env = env if env is not None else os.environ
+    create_streamer = create_streamer_factory(env, send_message)
+    queue = asyncio.Queue(maxsize=max_queue_size)
+    coalescer = create_coalescer(env, queue)
+    # Workers share the MCP client, toolset and model but each gets its own executors
+    workers = [
+        asyncio.create_task(mention_worker(
+            worker_id, queue, create_executor_factory(coral_tools, toolset, models, top_k), send_message, breaker,
+            create_streamer, router
+        ))
+        for worker_id in range(max_concurrency)
+    ]
+    print(f"Started {max_concurrency} mention workers with a queue of {max_queue_size}")
+    try:
+        await dispatch_mentions(wait_for_mentions, queue, timeout_ms, backoff, coalescer)
+    finally:
+        if coalescer is not None:
+            coalescer.cancel()
+        for worker in workers:
+            worker.cancel()
+
+async def create_agent(coral_tools, agent_tools, model):
     coral_tools_description = get_tools_description(coral_tools)
     agent_tools_description = get_tools_description(agent_tools)
     combined_tools = coral_tools + agent_tools
@@ -40,26 +1616,15 @@ async def create_agent(coral_tools, agent_tools):
 
     ])
 
-    model = init_chat_model(
-            model=os.getenv("MODEL_NAME", "gpt-4.1-mini"),
-            model_provider=os.getenv("MODEL_PROVIDER", "openai"),
-            api_key=os.getenv("API_KEY"),
-            temperature=os.getenv("MODEL_TEMPERATURE", "0.1"),
-            max_tokens=os.getenv("MODEL_TOKEN", "8000"),
-        )
     agent = create_tool_calling_agent(model, combined_tools, prompt)
     return AgentExecutor(agent=agent, tools=combined_tools, verbose=True)
 
-async def main():
-    runtime = os.getenv("CORAL_ORCHESTRATION_RUNTIME", "devmode")
-
-    if runtime == "docker" or runtime == "executable":
-        base_url = os.getenv("CORAL_SSE_URL")
-        agentID = os.getenv("CORAL_AGENT_ID")
-    else:
-        load_dotenv()
-        base_url = os.getenv("CORAL_SSE_URL")
-        agentID = os.getenv("CORAL_AGENT_ID")
+async def run_agent(env=None, model=None, httpx_client_factory=None):
+    # A host process passes its own env, model and pooled HTTP client factory to run several agents in one loop
+    env = env if env is not None else os.environ
+    model = model or create_model(env)
+    base_url = env.get("CORAL_SSE_URL")
+    agentID = env.get("CORAL_AGENT_ID")
 
     coral_params = {
         "agentId": agentID,
@@ -79,28 +1644,136 @@ async def main():
 				"timeout": 300,
 				"sse_read_timeout": 300
 			},
-			"github_mcp": {"transport": 'stdio', "command": 'npx', "args": ['-y', '@modelcontextprotocol/server-github'], "env": {"GITHUB_PERSONAL_ACCESS_TOKEN": os.getenv("GITHUB_PERSONAL_ACCESS_TOKEN")}}
+			"github_mcp": {"transport": 'stdio', "command": 'npx', "args": ['-y', '@modelcontextprotocol/server-github'], "env": {"GITHUB_PERSONAL_ACCESS_TOKEN": env.get("GITHUB_PERSONAL_ACCESS_TOKEN")}}
 		}
     )
+    if httpx_client_factory is not None:
+        client.connections["coral"]["httpx_client_factory"] = httpx_client_factory
+    client.connections[MCP_SERVER] = mcp_connection = expand_env(client.connections.get(MCP_SERVER) or {}, env)
+    # A remote MCP server is reached through a keep-alive pool shared by all workers, and by all
+    # agents when a host passes its pool in
+    http_pool = None
+    if mcp_connection.get("transport") in HTTP_TRANSPORTS:
+        if httpx_client_factory is None:
+            httpx_client_factory = http_pool = create_http_pool(env)
+        mcp_connection["httpx_client_factory"] = httpx_client_factory
 
     print("Multi Server Connection Established")
-    coral_tools = await client.get_tools(server_name='coral')
-    agent_tools = await client.get_tools(server_name='github_mcp')
+    # Both sessions are supervised and rebuilt in the background when they die. The agent's MCP
+    # server starts in the background too; with a snapshot the agent does not wait for it
+    use_snapshot = bool(TOOL_SNAPSHOT) and env.get("CORAL_TOOL_SNAPSHOT", "on") != "off"
+    # The executor runs the tool calls of one model turn concurrently. Stdio servers get a small
+    # default limit since some handle requests one at a time; HTTP servers are not limited
+    default_call_limit = 4 if mcp_connection.get("transport", "stdio") == "stdio" else 0
+    max_concurrent_calls = int(env.get("CORAL_MCP_MAX_CONCURRENCY",
+                                       AGENT_SETTINGS.get("maxConcurrentCalls", default_call_limit)))
+    # Hosted agents each record to the CORAL_RECORD_FILE from their own env
+    recorder.configure(env.get("CORAL_RECORD_FILE"))
+    coral_session = create_session(client, "coral", env)
+    mcp_session = create_session(client, MCP_SERVER, env, TOOL_SNAPSHOT if use_snapshot else None,
+                                 max_concurrent_calls)
+    try:
+        await serve_agent(env, model, coral_session, mcp_session)
+    finally:
+        await asyncio.gather(coral_session.aclose(), mcp_session.aclose())
+        if http_pool is not None:
+            await http_pool.aclose()
+
+async def serve_agent(env, model, coral_session, mcp_session):
+    with metrics.timer("coral_phase_seconds", phase="get_tools", server="coral"):
+        await coral_session.ready.wait()
+    coral_tools = coral_session.get_tools()
+    if mcp_session.snapshot is not None:
+        agent_tools = mcp_session.snapshot_tools()
+        fingerprint, generation = mcp_session.snapshot["fingerprint"], 0
+        print(f"Serving agent tools from the snapshot while {mcp_session.server_name} connects")
+    else:
+        with metrics.timer("coral_phase_seconds", phase="get_tools", server="agent"):
+            await mcp_session.ready.wait()
+        agent_tools = mcp_session.get_tools()
+        fingerprint, generation = mcp_session.live_fingerprint(), mcp_session.generation
 
     print(f"Coral tools count: {len(coral_tools)} and agent tools count: {len(agent_tools)}")
+
+    # Tool wrappers apply in order. The recorder goes first and sees the raw MCP results, which a replay
+    # stands in for. The cache keeps raw results too, since the output policy cuts them down per mention
+    wrappers = [recorder.wrap] if recorder.enabled else []
+    pinned_tools = []
+    cache_settings = AGENT_SETTINGS.get("toolCache")
+    if cache_settings:
+        tool_cache = ToolResultCache(cache_settings.get("tools", {}), cache_settings.get("maxEntries", 256))
+        wrappers.append(tool_cache.wrap)
+        print(f"Caching results for tools: {', '.join(tool_cache.ttls)}")
+    output_settings = AGENT_SETTINGS.get("toolOutput")
+    if output_settings:
+        store = OutputStore(env.get("CORAL_OUTPUT_STORE_DIR", ".coral_outputs"),
+                            output_settings.get("storeMaxEntries", 200), output_settings.get("pageBytes", 8000))
+        wrappers.append(ToolOutputPolicy(output_settings, store).wrap)
+        pinned_tools.append(store.create_tool())
+        print(f"Limiting tool output size, full outputs are stored in {store.store_dir}")
+    def prepare_tools(tools):
+        for wrap in wrappers:
+            tools = [wrap(tool) for tool in tools]
+        return tools
+    toolset = AgentToolset(prepare_tools(agent_tools), pinned_tools)
+    recorder.record_session(env, agent_tools)
+    schema_watch = asyncio.create_task(follow_live_schemas(mcp_session, toolset, prepare_tools, fingerprint,
+                                                           generation))
+    try:
+        await serve_mentions(env, model, coral_session, mcp_session, coral_tools, toolset)
+    finally:
+        schema_watch.cancel()
+        await asyncio.gather(schema_watch, return_exceptions=True)
+
+async def serve_mentions(env, model, coral_session, mcp_session, coral_tools, toolset):
+    max_concurrency = int(env.get("CORAL_MAX_CONCURRENCY", "1"))
+    # "direct" polls Coral from Python and only invokes the model when a mention arrives,
+    # "llm" keeps the model driving wait_for_mentions and send_message itself
+    poll_mode = env.get("CORAL_POLL_MODE", "direct" if max_concurrency > 1 else "llm")
+    if poll_mode == "direct" or max_concurrency > 1:
+        max_queue_size = int(env.get("CORAL_MAX_QUEUE_SIZE", str(max_concurrency * 2)))
+        timeout_ms = int(env.get("CORAL_WAIT_TIMEOUT_MS", "30000"))
+        top_k = int(env.get("CORAL_TOOL_TOP_K", "0"))
+        # With MODEL_FAST_NAME set, simple mentions go to a fast model and the rest to MODEL_NAME
+        models = {"strong": model}
+        router = create_router(env, toolset)
+        if router is not None:
+            models["fast"] = create_fast_model(env)
+        await run_worker_pool(coral_tools, toolset, models, max_concurrency, max_queue_size, timeout_ms, top_k,
+                              coral_session.backoff, mcp_session.breaker, env, router)
+        return
     
-    agent_executor = await create_agent(coral_tools, agent_tools)
+    agent_executor = await create_agent(coral_tools, toolset.all_tools(), model)
+    version = toolset.version
+    failures = 0
     
     while True:
         try:
+            if version != toolset.version:
+                agent_executor = await create_agent(coral_tools, toolset.all_tools(), model)
+                version = toolset.version
             print("Starting new agent invocation")
-            await agent_executor.ainvoke({"agent_scratchpad": []})
+            with metrics.timer("coral_phase_seconds", phase="agent_invocation"):
+                await agent_executor.ainvoke({"agent_scratchpad": []},
+                                             config={"callbacks": metrics.callbacks + recorder.callbacks})
             print("Completed agent invocation, restarting loop")
+            failures = 0
             await asyncio.sleep(1)
         except Exception as e:
             print(f"Error in agent loop: {str(e)}")
             print(traceback.format_exc())
-            await asyncio.sleep(5)
+            await asyncio.sleep(coral_session.backoff.delay(failures))
+            failures += 1
+
+async def main():
+    runtime = os.getenv("CORAL_ORCHESTRATION_RUNTIME", "devmode")
+
+    if runtime != "docker" and runtime != "executable":
+        load_dotenv()
+
+    # Keep a reference so the Prometheus endpoint stays up for the life of the agent
+    metrics_server = await configure_metrics()
+    await run_agent()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,81 @@
+import os, time, asyncio, argparse, traceback, importlib.util
+from dotenv import load_dotenv, dotenv_values
+from base_coraliser import Backoff, configure_metrics, create_http_pool, create_model, metrics
+
+
+def load_agent_module(agent_dir):
+    name = os.path.basename(os.path.normpath(agent_dir))
+    spec = importlib.util.spec_from_file_location(f"coralised_agents.{name}", os.path.join(agent_dir, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # Every hosted agent reports into the host's metrics registry
+    module.metrics = metrics
+    return name, module
+
+def load_agent_env(agent_dir):
+    env = dict(os.environ)
+    env_path = os.path.join(agent_dir, ".env")
+    if os.path.exists(env_path):
+        env.update({key: value for key, value in dotenv_values(env_path).items() if value is not None})
+    return env
+
+async def run_hosted_agent(name, module, env, model, http_pool, restart_delay):
+    backoff = Backoff(restart_delay, 300.0)
+    failures = 0
+    while True:
+        started = time.monotonic()
+        try:
+            print(f"Starting hosted agent {name} as {env.get('CORAL_AGENT_ID')}")
+            await module.run_agent(env, model, http_pool)
+            return
+        except Exception as e:
+            print(f"Hosted agent {name} stopped: {str(e)}")
+            print(traceback.format_exc())
+            # An agent that ran for a while before failing starts again from the shortest delay
+            if time.monotonic() - started > 300:
+                failures = 0
+            await asyncio.sleep(backoff.delay(failures))
+            failures += 1
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run several coralised agents in one process and event loop")
+    parser.add_argument("agents", nargs="+", help="generated agent directories, e.g. coralised_agents/github_mcp")
+    # The pool defaults to the CORAL_MCP_* settings that generated agents use
+    parser.add_argument("--max-connections", type=int,
+                        help="size of the shared HTTP connection pool, overrides CORAL_MCP_MAX_CONNECTIONS")
+    parser.add_argument("--max-keepalive", type=int,
+                        help="idle keep-alive connections kept in the shared pool, overrides CORAL_MCP_MAX_KEEPALIVE")
+    parser.add_argument("--keepalive-expiry", type=float,
+                        help="seconds an idle connection is kept, overrides CORAL_MCP_KEEPALIVE_EXPIRY")
+    parser.add_argument("--restart-delay", type=float, default=5.0,
+                        help="base delay before restarting an agent that failed, doubled on each repeated failure")
+    return parser.parse_args(argv)
+
+async def main(args=None):
+    args = args or parse_args()
+    load_dotenv()
+
+    # Keep a reference so the Prometheus endpoint stays up for the life of the host
+    metrics_server = await configure_metrics()
+    pool_env = dict(os.environ)
+    for key, value in (("CORAL_MCP_MAX_CONNECTIONS", args.max_connections),
+                       ("CORAL_MCP_MAX_KEEPALIVE", args.max_keepalive),
+                       ("CORAL_MCP_KEEPALIVE_EXPIRY", args.keepalive_expiry)):
+        if value is not None:
+            pool_env[key] = str(value)
+    http_pool = create_http_pool(pool_env, {})
+    model = create_model()
+
+    hosted_agents = []
+    for agent_dir in args.agents:
+        name, module = load_agent_module(agent_dir)
+        hosted_agents.append(run_hosted_agent(name, module, load_agent_env(agent_dir), model, http_pool, args.restart_delay))
+    print(f"Hosting {len(hosted_agents)} coralised agents in one process")
+
+    try:
+        await asyncio.gather(*hosted_agents)
+    finally:
+        await http_pool.aclose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
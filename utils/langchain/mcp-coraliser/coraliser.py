@@ -1,30 +1,224 @@
-import asyncio
-import traceback, json, copy, os
+import asyncio, argparse, time
+import traceback, json, copy, os, re, hashlib, pprint
+from contextlib import contextmanager, asynccontextmanager, AsyncExitStack
 from dotenv import load_dotenv
 from langchain.chat_models import init_chat_model
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import load_mcp_tools
+from mcp import ClientSession
+from mcp.client.sse import sse_client
+from mcp.client.streamable_http import streamablehttp_client
+from base_coraliser import (metrics, create_rate_limiter, get_tool_schema, tools_fingerprint, HTTP_TRANSPORTS,
+                            expand_env, create_http_pool)
 
 load_dotenv()
 
+DEFAULT_JOBS = int(os.getenv("CORALISER_JOBS", "4"))
+CACHE_DIR = os.getenv("CORALISER_CACHE_DIR", ".coraliser_cache")
+CACHE_MAX_ENTRIES = int(os.getenv("CORALISER_CACHE_MAX_ENTRIES", "256"))
+CACHE_MAX_AGE_DAYS = float(os.getenv("CORALISER_CACHE_MAX_AGE_DAYS", "30"))
+MANIFEST_FILENAME = ".coraliser_manifest.json"
+# Description calls are background work, so they yield to running agents sharing MODEL_RATE_LIMIT_FILE
+rate_limiter = create_rate_limiter(os.environ, "background")
+
+@contextmanager
+def phase_timer(timings, phase, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = time.perf_counter() - started
+        metrics.observe("coraliser_phase_seconds", timings[phase], phase=phase, **labels)
+
+def hash_text(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def hash_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def write_file_atomic(path, content, mode=None):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    if mode is not None:
+        os.chmod(tmp_path, mode)
+    os.replace(tmp_path, path)
+
+class DescriptionCache:
+
+    def __init__(self, cache_dir=CACHE_DIR, max_entries=CACHE_MAX_ENTRIES, max_age_days=CACHE_MAX_AGE_DAYS):
+        self.cache_dir = os.path.join(cache_dir, "descriptions")
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 24 * 60 * 60
+
+    def make_key(self, agent_name, tools_fingerprint, model_name):
+        payload = json.dumps(
+            {"agent": agent_name, "tools": tools_fingerprint, "model": model_name}, sort_keys=True
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.cache_dir, f"{key}.json")
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # An entry that is not an object was not written by the cache, so it is dropped as a miss
+        if not isinstance(entry, dict):
+            self.remove(path)
+            return None
+        if time.time() - entry.get("created", 0) > self.max_age:
+            self.remove(path)
+            return None
+        # Touch the entry so size-based eviction drops the least recently used ones first
+        os.utime(path)
+        return entry.get("description")
+
+    def put(self, key, description, **metadata):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, f"{key}.json")
+        entry = dict(metadata, description=description, created=time.time())
+        write_file_atomic(path, json.dumps(entry))
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".json")]
+        except OSError:
+            return
+        now = time.time()
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for index, entry in enumerate(entries):
+            if index >= self.max_entries or now - entry.stat().st_mtime > self.max_age:
+                self.remove(entry.path)
+
+@asynccontextmanager
+async def open_http_session(connection, httpx_client_factory=None):
+    # langchain-mcp-adapters 0.0.10 has neither the streamable HTTP transport nor pooled clients,
+    # so the coraliser opens sessions to remote servers with the MCP SDK itself
+    kwargs = {key: connection[key] for key in ("headers", "timeout", "sse_read_timeout") if key in connection}
+    if httpx_client_factory is not None:
+        kwargs["httpx_client_factory"] = httpx_client_factory
+    open_transport = sse_client if connection["transport"] == "sse" else streamablehttp_client
+    async with open_transport(connection["url"], **kwargs) as streams:
+        async with ClientSession(streams[0], streams[1]) as session:
+            await session.initialize()
+            yield session
+
 class AgentGenerator:
 
-    def __init__(self, agent_name, mcp_json):
+    def __init__(self, agent_name, mcp_json, description_cache=None, refresh=False, agent_settings=None,
+                 http_pool=None):
         self.agent_name = agent_name
         self.mcp_json = mcp_json
+        self.agent_settings = copy.deepcopy(agent_settings or {})
         self.client = None
+        self.tools = None
+        self.exit_stack = None
+        self.description_cache = description_cache
+        self.refresh = refresh
+        self.written_files = {}
+        self.http_pool = http_pool
     
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_tb):
+        await self.aclose()
+
+    async def connect(self):
+        if self.client is not None:
+            return self.client
+        mcp_object = self.get_agent_config()
+        if "env" in mcp_object:
+            mcp_object['env'] = {key: self.get_env_or_raise(key) for key in mcp_object['env']}
+        mcp_object = expand_env(mcp_object, {key: self.get_env_or_raise(key) for key in self.get_referenced_env()})
+        print(f"Checking connection with the MCP: {self.agent_name}")
+        exit_stack = AsyncExitStack()
+        try:
+            if mcp_object.get("transport") in HTTP_TRANSPORTS:
+                # Remote servers share the coraliser's keep-alive connection pool
+                session = await exit_stack.enter_async_context(open_http_session(mcp_object, self.http_pool))
+                self.tools = await load_mcp_tools(session)
+                self.client = session
+            else:
+                self.client = await exit_stack.enter_async_context(
+                    MultiServerMCPClient(connections={self.agent_name: mcp_object})
+                )
+        except BaseException:
+            await exit_stack.aclose()
+            raise
+        self.exit_stack = exit_stack
+        return self.client
+
+    async def aclose(self):
+        # The stdio transport runs in an anyio task group, so this must be awaited
+        # from the same task that called connect()
+        exit_stack, self.exit_stack = self.exit_stack, None
+        self.client = None
+        if exit_stack is not None:
+            await exit_stack.aclose()
+
+    def get_tools(self):
+        if self.tools is None:
+            if self.client is None:
+                raise RuntimeError(f"MCP session for {self.agent_name} is not connected")
+            self.tools = self.client.get_tools()
+        return self.tools
+
     def get_tools_description(self):
-        tools = self.client.get_tools()
+        tools = self.get_tools()
         return "\n".join(
             f"Tool: {tool.name}, Schema: {json.dumps(tool.args).replace('{', '{{').replace('}', '}}')}"
             for tool in tools
         )
+
+    def get_tools_fingerprint(self):
+        return tools_fingerprint(self.get_tools())
+
+    def get_tool_snapshot(self):
+        tools = self.get_tools()
+        if not tools:
+            return None
+        return {
+            "version": 1,
+            "fingerprint": self.get_tools_fingerprint(),
+            "tools": [
+                {"name": tool.name, "description": tool.description, "schema": get_tool_schema(tool)}
+                for tool in tools
+            ],
+        }
     
     def get_agent_config(self):
         return copy.deepcopy(self.mcp_json[self.agent_name])
+
+    def get_referenced_env(self):
+        # ${VAR} references in a remote server's URL or headers, resolved from the environment
+        return list(dict.fromkeys(re.findall(r"\$\{(\w+)\}", json.dumps(self.get_agent_config()))))
     
-    def get_mcp_description(self):
-        print('Creating MCP description for coral')
+    async def get_mcp_description(self):
+        model_name = os.getenv("MODEL_NAME", "gpt-4.1-mini")
+        cache_key = None
+        if self.description_cache is not None:
+            cache_key = self.description_cache.make_key(self.agent_name, self.get_tools_fingerprint(), model_name)
+            if not self.refresh:
+                description = self.description_cache.get(cache_key)
+                if description:
+                    print(f"Using cached description for {self.agent_name}: {description}")
+                    return description
+
+        print(f'Creating MCP description for coral: {self.agent_name}')
         formatted_tools = self.get_tools_description()
         system_prompt = (
             "You are an AI system tasked with summarizing the purpose and capabilities of an agent, "
@@ -39,21 +233,80 @@ class AgentGenerator:
         )
 
         llm_helper = init_chat_model(
-            model=os.getenv("MODEL_NAME", "gpt-4.1-mini"),
+            model=model_name,
             model_provider=os.getenv("MODEL_PROVIDER", "openai"),
             api_key=os.getenv("API_KEY"),
             temperature=os.getenv("MODEL_TEMPERATURE", "0.1"),
             max_tokens=os.getenv("MODEL_TOKEN", "8000"),
-            model_kwargs={"response_format": {"type": "json_object"}}
+            model_kwargs={"response_format": {"type": "json_object"}},
+            **(rate_limiter.model_kwargs() if rate_limiter is not None else {})
         )
 
-        response = llm_helper.invoke(system_prompt)
+        response = await llm_helper.ainvoke(system_prompt, config={"callbacks": metrics.callbacks})
         response = response.content
         description = json.loads(response)["description"]
-        print(f"Generated description: {description}")
+        print(f"Generated description for {self.agent_name}: {description}")
+        if cache_key is not None:
+            self.description_cache.put(cache_key, description, agent=self.agent_name, model=model_name)
 
         return description
 
+    def get_output_dir(self):
+        return os.path.join("coralised_agents", self.agent_name.lower())
+
+    def get_manifest_inputs(self):
+        base_dir = os.path.dirname(__file__)
+        return {
+            "config": hash_text(json.dumps(self.get_agent_config(), sort_keys=True)),
+            "settings": hash_text(json.dumps(self.agent_settings, sort_keys=True)),
+            "tools": self.get_tools_fingerprint(),
+            # The fingerprint leaves out tool descriptions, which the embedded snapshot carries
+            "snapshot": hash_text(json.dumps(self.get_tool_snapshot(), sort_keys=True)),
+            "template": hash_file(os.path.join(base_dir, 'base_coraliser.py')),
+            # create_agent renders the .env_sample, pyproject.toml and run_agent.sh inline
+            "generator": hash_file(os.path.abspath(__file__)),
+        }
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.get_output_dir(), MANIFEST_FILENAME), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_up_to_date(self):
+        manifest = self.load_manifest()
+        if not manifest or manifest.get("inputs") != self.get_manifest_inputs():
+            return False
+        output_dir = self.get_output_dir()
+        return all(
+            hash_file(os.path.join(output_dir, name)) == digest
+            for name, digest in manifest.get("files", {}).items()
+        )
+
+    def write_agent_file(self, filename, content, mode=None):
+        digest = hash_text(content)
+        self.written_files[os.path.basename(filename)] = digest
+        if hash_file(filename) == digest:
+            if mode is not None and os.stat(filename).st_mode & 0o777 != mode:
+                os.chmod(filename, mode)
+            print(f"File '{filename}' unchanged.")
+            return False
+        write_file_atomic(filename, content, mode)
+        print(f"File '{filename}' created successfully.")
+        return True
+
+    def write_manifest(self, agent_description):
+        manifest = {
+            "inputs": self.get_manifest_inputs(),
+            "description": agent_description,
+            "files": self.written_files,
+        }
+        content = json.dumps(manifest, indent=2, sort_keys=True)
+        manifest_path = os.path.join(self.get_output_dir(), MANIFEST_FILENAME)
+        if hash_file(manifest_path) != hash_text(content):
+            write_file_atomic(manifest_path, content)
+
     def get_env_or_raise(self, key):
         val = os.getenv(key)
         if not val:
@@ -62,20 +315,16 @@ class AgentGenerator:
 
     async def check_connection(self):
         try:
-            mcp_object = self.get_agent_config()
-            if "env" in mcp_object:
-                mcp_object['env'] = {key: self.get_env_or_raise(key) for key in mcp_object['env']}
-            print(f"Checking connection with the MCP: {self.agent_name}")
-            async with MultiServerMCPClient(connections={self.agent_name: mcp_object}) as client:
-                self.client = client
-                session = self.client.sessions
-                return True
+            await self.connect()
+            self.get_tools()
+            return True
         except Exception as e:
-            print(f"Failed to establish connection: {e}")
+            print(f"Failed to establish connection with {self.agent_name}: {e}")
             print(traceback.format_exc())
             return False    
     
     def create_agent(self, agent_description):
+        self.written_files = {}
         items = []
         env_code_str = None
         mcp_object = self.get_agent_config()
@@ -83,7 +332,7 @@ class AgentGenerator:
         for key, val in mcp_object.items():
             if key == "env":
                 env_code_str = "{" + ", ".join(
-                    f'"{k}": os.getenv("{k}")' for k in val
+                    f'"{k}": env.get("{k}")' for k in val
                 ) + "}"
                 val_str = env_code_str
             else:
@@ -100,17 +349,20 @@ class AgentGenerator:
         base_code = base_code.replace('"agentId": "",', f'"agentId": agentID,')
         base_code = base_code.replace('"agentDescription": ""', f'"agentDescription": "{agent_description}"')
         base_code = base_code.replace('"mcp": ""', mcp_dict_code)
-        base_code = base_code.replace("agent_tools = await client.get_tools(server_name='mcp')",
-                                      f"agent_tools = await client.get_tools(server_name='{self.agent_name}')")
+        base_code = base_code.replace("AGENT_SETTINGS = {}", f"AGENT_SETTINGS = {self.agent_settings!r}")
+        base_code = base_code.replace('MCP_SERVER = "mcp"', f'MCP_SERVER = "{self.agent_name}"')
+        tool_snapshot = self.get_tool_snapshot()
+        if tool_snapshot is not None:
+            base_code = base_code.replace(
+                "TOOL_SNAPSHOT = None",
+                f"TOOL_SNAPSHOT = {pprint.pformat(tool_snapshot, width=120, sort_dicts=False)}"
+            )
 
         # Create the directory agent/<agent_name> if it doesn't exist
-        output_dir = os.path.join("coralised_agents", self.agent_name.lower())
+        output_dir = self.get_output_dir()
         os.makedirs(output_dir, exist_ok=True)
         filename = os.path.join(output_dir, f"main.py")
-        
-        with open(filename, "w") as f:
-            f.write(base_code)
-        print(f"File '{filename}' created successfully.")
+        changed = self.write_agent_file(filename, base_code)
 
         # Create the .env file with specified keys
         env_filename = os.path.join(output_dir, ".env_sample")
@@ -120,6 +372,8 @@ class AgentGenerator:
         if "env" in mcp_object:
             for key in mcp_object["env"]:
                 env_vars[key] = ""
+        for key in self.get_referenced_env():
+            env_vars[key] = ""
         
         # Add hardcoded environment variables
         env_vars.update({
@@ -129,6 +383,8 @@ class AgentGenerator:
             "MODEL_TEMPERATURE": "0.0",
             "API_KEY": "",
             "CORAL_AGENT_ID": self.agent_name.lower(),
+            "CORAL_POLL_MODE": "direct",
+            "CORAL_TOOL_SNAPSHOT": "on",
             "CORAL_SSE_URL": "http://localhost:5555/devmode/exampleApplication/privkey/session1/sse"
         })
 
@@ -136,9 +392,7 @@ class AgentGenerator:
         env_content = "\n".join(
             f"{key}={value}" for key, value in env_vars.items()
         )
-        with open(env_filename, "w") as f:
-            f.write(env_content)
-        print(f"File '{env_filename}' created successfully.")
+        changed = self.write_agent_file(env_filename, env_content) or changed
 
          # Create the pyproject.toml file
         pyproject_filename = os.path.join(output_dir, "pyproject.toml")
@@ -158,9 +412,7 @@ dependencies = [
     "uv>=0.7.17",
 ]
 """
-        with open(pyproject_filename, "w") as f:
-            f.write(pyproject_content)
-        print(f"File '{pyproject_filename}' created successfully.")
+        changed = self.write_agent_file(pyproject_filename, pyproject_content) or changed
 
         # Create the run_agent.sh file
         run_agent_filename = os.path.join(output_dir, "run_agent.sh")
@@ -202,30 +454,89 @@ source "$VENV_ACTIVATE" || { echo "Error: Failed to activate virtual environment
 echo "Running $PYTHON_SCRIPT..."
 uv run "$PYTHON_SCRIPT" || { echo "Error: Failed to run $PYTHON_SCRIPT" >&2; exit 1; }
 """
-        with open(run_agent_filename, "w") as f:
-            f.write(run_agent_content)
         # Set executable permissions for the shell script
-        os.chmod(run_agent_filename, 0o755)
-        print(f"File '{run_agent_filename}' created successfully.")
+        changed = self.write_agent_file(run_agent_filename, run_agent_content, mode=0o755) or changed
+
+        self.write_manifest(agent_description)
+        return changed
+
+async def coralise_agent(agent_name, mcp_json, semaphore, description_cache=None, refresh=False, agent_settings=None,
+                         http_pool=None):
+    timings = {}
+    status = "failed"
+    async with semaphore:
+        with phase_timer(timings, "total", agent=agent_name):
+            try:
+                async with AgentGenerator(agent_name, mcp_json, description_cache, refresh,
+                                          agent_settings, http_pool) as agent_generator:
+                    with phase_timer(timings, "connect", agent=agent_name):
+                        connected = await agent_generator.check_connection()
+                    if connected and not refresh and agent_generator.is_up_to_date():
+                        print(f"Coralised agent {agent_name} is up to date, skipping")
+                        status = "unchanged"
+                    elif connected:
+                        with phase_timer(timings, "describe", agent=agent_name):
+                            description = await agent_generator.get_mcp_description()
+                        with phase_timer(timings, "write", agent=agent_name):
+                            changed = await asyncio.to_thread(agent_generator.create_agent, description)
+                        status = "created" if changed else "unchanged"
+                    else:
+                        status = "unreachable"
+            except Exception as e:
+                print(f"Failed creating coralised agent {agent_name}: {e}")
+                print(traceback.format_exc())
+    return agent_name, status, timings
+
+def print_summary(results, elapsed):
+    created = sum(1 for _, status, _ in results if status == "created")
+    unchanged = sum(1 for _, status, _ in results if status == "unchanged")
+    print(f"\nCoralisation summary: {created} created, {unchanged} unchanged, "
+          f"{len(results) - created - unchanged} failed out of {len(results)} agents in {elapsed:.2f}s")
+    for agent_name, status, timings in results:
+        phases = "  ".join(
+            f"{phase} {timings[phase]:.2f}s"
+            for phase in ("connect", "describe", "write", "total") if phase in timings
+        )
+        print(f"  {agent_name:<24} {status:<12} {phases}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate coralised agents from coraliser_settings.json")
+    parser.add_argument("--jobs", "-j", type=int, default=DEFAULT_JOBS,
+                        help="number of MCP servers to coralise concurrently")
+    parser.add_argument("--refresh", action="store_true",
+                        help="ignore cached descriptions and ask the LLM again")
+    parser.add_argument("--metrics-file", default=os.getenv("CORALISER_METRICS_FILE"),
+                        help="append phase, model call and token metrics to this JSONL file")
+    return parser.parse_args(argv)
 
-async def main():
+async def main(args=None):
+    args = args or parse_args()
+    if args.metrics_file:
+        metrics.configure("jsonl", args.metrics_file)
     with open(r'coraliser_settings.json', 'r') as f:
         config = f.read()
     
     mcp_json = json.loads(config)
     agent_list = list(mcp_json['mcpServers'].keys())
     print(f"List of available agents: {agent_list}")
+    agent_settings = mcp_json.get('agentSettings', {})
     mcp_json = mcp_json['mcpServers']
-    
-    for agent_name in agent_list:
-        try:
-            agent_generator = AgentGenerator(agent_name, mcp_json)
-            if await agent_generator.check_connection():
-                description = agent_generator.get_mcp_description()
-                agent_generator.create_agent(description)
-        except Exception as e:
-            print(f"Failed creating coralised agent: {e}")
-            print(traceback.format_exc())
+
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(max(1, args.jobs))
+    description_cache = DescriptionCache()
+    # One keep-alive pool serves every remote MCP server, sized by CORAL_MCP_MAX_CONNECTIONS
+    http_pool = create_http_pool(os.environ, {})
+    try:
+        results = await asyncio.gather(
+            *(coralise_agent(agent_name, mcp_json, semaphore, description_cache, args.refresh,
+                             agent_settings.get(agent_name), http_pool)
+              for agent_name in agent_list)
+        )
+    finally:
+        await http_pool.aclose()
+    print_summary(results, time.perf_counter() - started)
+    return results
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file